@@ -0,0 +1,375 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""
+Load generator for the cip server.
+
+Starts src/server.py on localhost against a throwaway home directory, seeds
+it with a user and one package per payload size, then has a number of
+client processes hammer it with a weighted mix of install, upload, auth and
+user get requests. Every payload size is reported separately:
+
+    python bench/bench.py --clients 8 --duration 5 --sizes 1K,1M,64M
+    python bench/bench.py --compare bench/baseline.json
+    python bench/bench.py --output bench/baseline.json
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import socket
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from pathlib import Path
+from hashlib import sha256
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+from protocol import Connection
+
+SIZES = "1K,64K,1M,16M,128M,500M"
+MIX = "install=70,user=10,auth=10,upload=10"
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+PASSWORD = sha256(b"bench").hexdigest()
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    for unit in ("G", "M", "K"):
+        if size >= UNITS[unit] and not size % UNITS[unit]:
+            return f"{size // UNITS[unit]}{unit}"
+    return str(size)
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        op, _, weight = part.partition("=")
+        if op not in OPS:
+            raise SystemExit(f"Unknown operation {op}, expected one of {', '.join(OPS)}")
+        weights[op] = float(weight or 1)
+    return weights
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss(pid):
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    fields[key] = int(value.split()[0]) << 10
+    except FileNotFoundError:
+        pass
+    return fields.get("VmRSS", 0), fields.get("VmHWM", 0)
+
+
+def children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except FileNotFoundError:
+        return []
+
+
+class Sink:
+    def __init__(self):
+        self.size = 0
+
+    def seek(self, offset):
+        self.size = offset
+
+    def truncate(self):
+        pass
+
+    def write(self, data):
+        self.size += len(data)
+
+
+class BenchClient(Connection):
+    def __init__(self, address):
+        conn = socket.create_connection(address)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().__init__(conn)
+        self.greet()
+        self.token = None
+
+    def request(self, cmd):
+        self.send(cmd)
+        return self.recv()
+
+    def login(self):
+        self.token = self.request({"type": "session", "username": "bench", "password": PASSWORD})["reply"]
+        return self.token
+
+    def upload(self, package, version, path, digest, description=""):
+        size = os.path.getsize(path)
+        reply = self.request({"type": "upload", "user": "bench", "package": package, "version": version,
+                              "size": size, "digest": digest, "dependencies": (), "description": description,
+                              "token": self.token})
+        if reply["reply"] != "ready":
+            raise RuntimeError(f"Upload of {package} {version} refused: {reply['reply']}")
+        with open(path, "rb") as f:
+            self.send_file(f, reply["offset"])
+        if (reply := self.recv())["reply"] != "success":
+            raise RuntimeError(f"Upload of {package} {version} failed: {reply['reply']}")
+        return size
+
+    def install(self, package):
+        reply = self.request({"type": "install", "package": package, "version": "RECENT"})
+        if reply["reply"] != "success":
+            raise RuntimeError(f"Install of {package} failed: {reply['reply']}")
+        sink = Sink()
+        self.recv_stream(sink, reply["offset"])
+        return sink.size
+
+    def close(self):
+        try:
+            self.send({"type": "quit"})
+        finally:
+            self.conn.close()
+
+
+def op_install(client, job, i):
+    return client.install(job["package"])
+
+
+def op_upload(client, job, i):
+    return client.upload(f"bench-w{job['worker']}", f"{job['round']}.{i}", job["path"], job["digest"])
+
+
+def op_auth(client, job, i):
+    client.request({"type": "auth", "username": "bench", "password": PASSWORD})
+    return 0
+
+
+def op_user(client, job, i):
+    client.request({"type": "user", "method": "get", "user": f"filler{i % job['fillers']}" if job["fillers"] else "bench"})
+    return 0
+
+
+OPS = {
+    "install": op_install,
+    "upload": op_upload,
+    "auth": op_auth,
+    "user": op_user,
+}
+
+
+def worker(job):
+    rng = random.Random(job["worker"])
+    ops, weights = zip(*job["mix"].items())
+    latencies = {op: [] for op in ops}
+    moved = 0
+
+    client = BenchClient(job["address"])
+    client.login()
+    deadline = time.perf_counter() + job["duration"]
+    i = 0
+    while time.perf_counter() < deadline or not i:
+        op = rng.choices(ops, weights)[0]
+        start = time.perf_counter()
+        moved += OPS[op](client, job, i)
+        latencies[op].append(time.perf_counter() - start)
+        i += 1
+    client.close()
+    return latencies, moved
+
+
+class BenchServer:
+    def __init__(self, home, asynchronous=False, workers=0):
+        self.address = ("127.0.0.1", free_port())
+        args = [sys.executable, str(ROOT / "src" / "server.py"), "--host", self.address[0], "--port", str(self.address[1]),
+                "--data", str(Path(home) / ".cip"), "--workers", str(workers)] + (["--async"] if asynchronous else [])
+        # A separate home keeps the user's own config file out of the run.
+        self.process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                        env={**os.environ, "HOME": str(home)})
+
+        for _ in range(200):
+            if self.process.poll() is not None:
+                raise RuntimeError("Server exited during startup")
+            try:
+                socket.create_connection(self.address).close()
+                return
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        raise RuntimeError("Server did not start listening")
+
+    def rss(self):
+        # Pre-forked workers are counted too, pages they share with the
+        # coordinator once for every process.
+        pids = [self.process.pid] + children(self.process.pid)
+        return tuple(map(sum, zip(*(rss(pid) for pid in pids))))
+
+    def stop(self):
+        self.process.kill()
+        self.process.wait()
+
+
+def make_payload(root, size):
+    path = root / f"payload-{format_size(size)}"
+    digest = sha256()
+    with open(path, "wb") as f:
+        left = size
+        while left:
+            # Random bytes so compression can't make the transfer look cheaper
+            # than it is for real compiled artifacts.
+            chunk = os.urandom(min(left, 1 << 20))
+            digest.update(chunk)
+            f.write(chunk)
+            left -= len(chunk)
+    return path, digest.hexdigest()
+
+
+def seed(server, root, fillers):
+    client = BenchClient(server.address)
+    client.request({"type": "user", "method": "create", "username": "bench", "password": PASSWORD,
+                    "email": "", "website": "", "github": "", "description": "benchmark user"})
+    client.login()
+
+    # A registry with some other users and packages in it, so lookups aren't
+    # answered from a handful of dict entries.
+    path, digest = make_payload(root, 1 << 10)
+    for i in range(fillers):
+        client.request({"type": "user", "method": "create", "username": f"filler{i}", "password": PASSWORD,
+                        "email": "", "website": "", "github": "", "description": ""})
+        client.upload(f"filler-{i}", "1.0", path, digest, f"filler package number {i}")
+    client.close()
+
+
+def run_size(server, root, size, args, mix, round_):
+    path, digest = make_payload(root, size)
+    package = f"bench-{format_size(size).lower()}"
+    client = BenchClient(server.address)
+    client.login()
+    client.upload(package, "1.0", path, digest)
+    client.close()
+
+    jobs = [{"worker": w, "address": server.address, "duration": args.duration, "mix": mix, "round": round_,
+             "package": package, "path": str(path), "digest": digest, "fillers": args.fillers}
+            for w in range(args.clients)]
+
+    peak = server.rss()[0]
+    start = time.perf_counter()
+    with multiprocessing.get_context("fork").Pool(args.clients) as pool:
+        result = pool.map_async(worker, jobs)
+        while not result.ready():
+            peak = max(peak, server.rss()[0])
+            result.wait(0.05)
+        results = result.get()
+    elapsed = time.perf_counter() - start
+    os.remove(path)
+
+    latencies = {op: sorted(sample for lat, _ in results for sample in lat[op]) for op in mix}
+    total = sum(len(samples) for samples in latencies.values())
+    moved = sum(moved for _, moved in results)
+    return {
+        "size": size,
+        "ops": total,
+        "ops_per_sec": total / elapsed,
+        "bytes_per_sec": moved / elapsed,
+        "server_rss": server.rss()[0],
+        "server_rss_peak": peak,
+        "latency": {op: {"count": len(samples), "p50_ms": percentile(samples, 0.5) * 1000,
+                         "p99_ms": percentile(samples, 0.99) * 1000} for op, samples in latencies.items()},
+    }
+
+
+def report(results, baseline=None):
+    base = {r["size"]: r for r in baseline["results"]} if baseline else {}
+    for r in results:
+        ops = " ".join(f"{op} {lat['p50_ms']:.2f}/{lat['p99_ms']:.2f}" for op, lat in r["latency"].items() if lat["count"])
+        print(f"{format_size(r['size']):>6} {r['ops_per_sec']:>10.1f} {r['bytes_per_sec'] / (1 << 20):>9.1f} "
+              f"{r['server_rss'] / (1 << 20):>8.1f} {r['server_rss_peak'] / (1 << 20):>8.1f}  {ops}")
+        if (old := base.get(r["size"])) is not None:
+            changes = [f"ops/s {r['ops_per_sec'] / old['ops_per_sec'] - 1:+.1%}"]
+            if old["bytes_per_sec"]:
+                changes.append(f"MB/s {r['bytes_per_sec'] / old['bytes_per_sec'] - 1:+.1%}")
+            for op, lat in r["latency"].items():
+                if lat["count"] and old["latency"].get(op, {}).get("p99_ms"):
+                    changes.append(f"{op} p99 {lat['p99_ms'] / old['latency'][op]['p99_ms'] - 1:+.1%}")
+            print(f"{'':>6} vs baseline: {', '.join(changes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cip server")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent client processes")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of traffic per payload size")
+    parser.add_argument("--sizes", default=SIZES, help=f"payload sizes to run (default {SIZES})")
+    parser.add_argument("--mix", default=MIX, help=f"weighted operation mix (default {MIX})")
+    parser.add_argument("--fillers", type=int, default=200, help="extra users and packages to seed the registry with")
+    parser.add_argument("--async", dest="asynchronous", action="store_true", help="run the asyncio server")
+    parser.add_argument("--workers", type=int, default=0, help="pre-forked server worker processes")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory(prefix="cip-bench-") as tmp:
+        root = Path(tmp)
+        server = BenchServer(root / "home", args.asynchronous, args.workers)
+        try:
+            seed(server, root, args.fillers)
+            results = []
+            print(f"{'size':>6} {'ops/s':>10} {'MB/s':>9} {'rss MB':>8} {'peak MB':>8}  latency p50/p99 ms")
+            for round_, size in enumerate(sizes):
+                results.append(run_size(server, root, size, args, mix, round_))
+                report(results[-1:], baseline)
+        finally:
+            server.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"clients": args.clients, "duration": args.duration, "mix": mix, "fillers": args.fillers,
+                       "async": args.asynchronous, "workers": args.workers, "cpus": os.cpu_count(), "python": sys.version.split()[0],
+                       "results": results}, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""
+Concurrency stress test for the cip server.
+
+Hammers a live server with thousands of concurrent registry mutations that
+are meant to collide: the same username created twice at once, the same new
+package claimed by several users, the same version uploaded twice, users
+deleted while their uploads are still streaming. All of this runs while
+readers install, search and list users. Afterwards every upload the server
+acknowledged must be there, nothing it refused may be, and the same has to
+hold again after a restart replays the journal. Exits non zero on failure:
+
+    python bench/stress.py --threads 32 --rounds 100
+"""
+
+import os
+import sys
+import random
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from collections import Counter
+
+from bench import ROOT, PASSWORD, BenchClient, BenchServer, Sink, make_payload
+
+sys.path.insert(0, str(ROOT / "src"))
+
+from registry import Registry
+
+
+class Failures:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = []
+
+    def add(self, message):
+        with self.lock:
+            self.messages.append(message)
+
+    def check(self, ok, message):
+        if not ok:
+            self.add(message)
+
+
+def run_threads(target, count):
+    errors = []
+
+    def wrapper(i):
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(f"thread {i}: {type(e).__name__}: {e}")
+
+    threads = [threading.Thread(target=wrapper, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def stress_registry(failures, rounds):
+    # Readers walk a package's versions and its owner's listing while a
+    # writer keeps adding to them, nothing may come back half updated.
+    registry = Registry()
+    registry.add_user("owner", PASSWORD, "", "", "", "")
+    registry.add_package("owner", "lib", "1.0.0", "0" * 64, 1)
+    done = threading.Event()
+
+    def writer():
+        for i in range(1, rounds * 50):
+            registry.add_package("owner", "lib", f"1.{i}.0", "0" * 64, 1)
+            registry.add_package("owner", f"lib{i}", "1.0", "0" * 64, 1)
+        done.set()
+
+    def reader(i):
+        while not done.is_set():
+            ver = registry.get_version("lib", "^1")
+            failures.check(not isinstance(ver, str) and ver.owner.satisfies(ver, "^1"), f"range lookup returned {ver}")
+            failures.check(registry.get_version("lib", "RECENT").version.startswith("1."), "no latest version")
+            str(registry.users["owner"])
+
+    threading.Thread(target=writer).start()
+    failures.messages.extend(run_threads(reader, 8))
+
+
+def stress_server(failures, server, payload, threads, rounds):
+    path, digest = payload
+    created = Counter()
+    uploaded = Counter()
+    claimed = {}
+    lock = threading.Lock()
+
+    def create_users(i):
+        # Two threads race for every username.
+        client = BenchClient(server.address)
+        for n in range(rounds):
+            name = f"user{(i // 2) * rounds + n}"
+            reply = client.request({"type": "user", "method": "create", "username": name, "password": PASSWORD,
+                                    "email": "", "website": "", "github": "", "description": ""})
+            if reply["reply"] == "success":
+                with lock:
+                    created[name] += 1
+        client.close()
+
+    failures.messages.extend(run_threads(create_users, threads - threads % 2))
+    for name, count in created.items():
+        failures.check(count == 1, f"{name} was created {count} times")
+    failures.check(len(created) == (threads // 2) * rounds, f"{len(created)} users created")
+
+    users = sorted(created)
+    doomed = set(users[:len(users) // 10])
+
+    def mutate(i):
+        rng = random.Random(i)
+        client = BenchClient(server.address)
+        for n in range(rounds):
+            user = users[rng.randrange(len(users))]
+            client.token = client.request({"type": "session", "username": user, "password": PASSWORD})["reply"]
+            if not client.token:
+                continue
+
+            choice = rng.random()
+            if choice < 0.5:
+                # Versions of the user's own package, now and then the same
+                # version from two threads at once.
+                package, version = f"pkg-{user}", f"1.{rng.randrange(rounds * 2)}"
+            elif choice < 0.8 and user not in doomed:
+                # New packages that several users try to claim. Users that
+                # are about to be deleted stay out of it, once they are gone
+                # someone else may rightfully claim the name again.
+                package, version = f"shared-{rng.randrange(rounds)}", f"2.{i}.{n}"
+            else:
+                package, version = f"own-{i}-{n}", "1.0"
+
+            reply = client.request({"type": "upload", "user": user, "package": package, "version": version,
+                                    "size": os.path.getsize(path), "digest": digest, "dependencies": (),
+                                    "description": "", "token": client.token})
+            if reply["reply"] != "ready":
+                continue
+            with open(path, "rb") as f:
+                client.send_file(f, reply["offset"])
+            if client.recv()["reply"] == "success":
+                with lock:
+                    uploaded[package, version] += 1
+                    claimed.setdefault(package, set()).add(user)
+        client.close()
+
+    def delete(i):
+        client = BenchClient(server.address)
+        for user in sorted(doomed)[i::4]:
+            token = client.request({"type": "session", "username": user, "password": PASSWORD})["reply"]
+            if token:
+                client.request({"type": "user", "method": "delete", "user": user, "token": token})
+        client.close()
+
+    def read(i):
+        rng = random.Random(-i)
+        client = BenchClient(server.address)
+        for _ in range(rounds * 4):
+            client.request({"type": "user", "method": "get", "user": users[rng.randrange(len(users))]})
+            client.request({"type": "search", "query": "shared", "page": 1})
+            reply = client.request({"type": "install", "package": f"shared-{rng.randrange(rounds)}", "version": "RECENT"})
+            if reply["reply"] == "success":
+                client.recv_stream(Sink(), 0)
+        client.close()
+
+    def work(i):
+        if i < threads:
+            mutate(i)
+        elif i < threads + 4:
+            delete(i - threads)
+        else:
+            read(i)
+
+    failures.messages.extend(run_threads(work, threads + 8))
+    for key, count in uploaded.items():
+        failures.check(count == 1, f"{key} was accepted {count} times")
+    for package, owners in claimed.items():
+        failures.check(len(owners) == 1, f"{package} was claimed by {sorted(owners)}")
+    return users, doomed, uploaded, claimed
+
+
+def verify(failures, server, users, doomed, uploaded, claimed, label):
+    client = BenchClient(server.address)
+    for (package, version), _ in uploaded.items():
+        owner = next(iter(claimed[package]))
+        exists = client.request({"type": "version", "package": package, "version": version})["reply"]
+        failures.check(exists == (owner not in doomed), f"{label}: {package} {version} exists={exists}, owner {owner}")
+        if exists:
+            taken = client.request({"type": "package", "user": owner, "package": package})["reply"]
+            failures.check(not taken, f"{label}: {package} isn't owned by {owner}")
+
+    for user in users:
+        missing = client.request({"type": "user", "method": "verify", "username": user})["reply"] == "success"
+        failures.check(missing == (user in doomed), f"{label}: {user} missing={missing}")
+
+    stats = client.request({"type": "stats"})["reply"]
+    failures.check(stats["connections"] == 1, f"{label}: {stats['connections']} connections still counted")
+    client.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress the cip server with concurrent mutations")
+    parser.add_argument("--threads", type=int, default=32, help="concurrent mutating clients")
+    parser.add_argument("--rounds", type=int, default=100, help="operations per client")
+    parser.add_argument("--async", dest="asynchronous", action="store_true", help="run the asyncio server")
+    parser.add_argument("--workers", type=int, default=0, help="pre-forked server worker processes")
+    args = parser.parse_args()
+
+    failures = Failures()
+    stress_registry(failures, args.rounds)
+    print(f"registry: {len(failures.messages)} failures")
+
+    with tempfile.TemporaryDirectory(prefix="cip-stress-") as tmp:
+        root = Path(tmp)
+        payload = make_payload(root, 1 << 10)
+        server = BenchServer(root / "home", args.asynchronous, args.workers)
+        try:
+            users, doomed, uploaded, claimed = stress_server(failures, server, payload, args.threads, args.rounds)
+            stats = verify(failures, server, users, doomed, uploaded, claimed, "live")
+        finally:
+            server.stop()
+        print(f"server: {len(users)} users, {len(doomed)} deleted, {len(uploaded)} uploads accepted, "
+              f"{sum(c['count'] for c in stats['commands'].values())} requests")
+
+        server = BenchServer(root / "home", args.asynchronous, args.workers)
+        try:
+            verify(failures, server, users, doomed, uploaded, claimed, "restarted")
+        finally:
+            server.stop()
+
+    for message in failures.messages[:50]:
+        print(message)
+    print(f"{len(failures.messages)} failures")
+    sys.exit(1 if failures.messages else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+import zlib
+import shutil
+import struct
+import zipfile
+import threading
+import multiprocessing
+from pathlib import PurePosixPath
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+LOCAL = struct.Struct("<IHHHHHIIIHH")
+CENTRAL = struct.Struct("<IHHHHHHIIIHHHHHII")
+END = struct.Struct("<IHHHHIIH")
+
+# Every entry gets the same timestamp (1980-01-01 00:00, the zip epoch) so the
+# same tree always produces the same bytes and therefore the same digest.
+DOS_TIME = 0
+DOS_DATE = (1 << 5) | 1
+UTF8 = 0x800
+STORED = 0
+DEFLATED = 8
+
+# Below this many bytes of input starting worker processes costs more than
+# it saves.
+PARALLEL_THRESHOLD = 1 << 20
+LIMIT = 0xFFFFFFFF
+
+
+def compress(path, level):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    packed = comp.compress(data) + comp.flush()
+    if len(packed) >= len(data):
+        return zlib.crc32(data), len(data), STORED, data
+    return zlib.crc32(data), len(data), DEFLATED, packed
+
+
+def walk(root):
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        rel = os.path.relpath(dirpath, root)
+        if rel != ".":
+            entries.append((rel.replace(os.sep, "/") + "/", None))
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            entries.append((os.path.relpath(path, root).replace(os.sep, "/"), path))
+    return entries
+
+
+def compressed(paths, level, workers):
+    if sum(os.path.getsize(path) for path in paths) < PARALLEL_THRESHOLD:
+        for path in paths:
+            yield compress(path, level)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(workers, mp_context=context) as pool:
+        # Keep a bounded window of files in flight and hand results back in
+        # submission order, so memory stays flat and the output is stable.
+        window = workers * 4
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(compress, path, level))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def build(root, level=6, workers=None):
+    entries = walk(root)
+    results = compressed([path for _, path in entries if path is not None], level, workers)
+
+    central = []
+    offset = 0
+    for name, path in entries:
+        encoded = name.encode()
+        if path is None:
+            crc, size, method, data = 0, 0, STORED, b""
+            attr = (0o40755 << 16) | 0x10
+        else:
+            crc, size, method, data = next(results)
+            attr = (os.stat(path).st_mode & 0xFFFF) << 16
+
+        if size > LIMIT or offset > LIMIT or len(central) >= 0xFFFF:
+            raise ValueError("Package is too large for a zip archive")
+
+        header = LOCAL.pack(0x04034B50, 20, UTF8, method, DOS_TIME, DOS_DATE, crc, len(data), size, len(encoded), 0) + encoded
+        central.append(CENTRAL.pack(0x02014B50, 0x031E, 20, UTF8, method, DOS_TIME, DOS_DATE, crc, len(data), size,
+                                    len(encoded), 0, 0, 0, 0, attr, offset) + encoded)
+        yield header
+        yield data
+        offset += len(header) + len(data)
+
+    directory = b"".join(central)
+    yield directory
+    yield END.pack(0x06054B50, 0, 0, len(central), len(central), len(directory), offset, 0)
+
+
+def member_path(dest, name):
+    parts = PurePosixPath(name).parts
+    if not parts or name.startswith("/") or "\\" in name or any(part in ("..", "") or ":" in part for part in parts):
+        raise zipfile.BadZipFile(f"Unsafe path in archive: {name}")
+    return os.path.join(dest, *parts)
+
+
+def extract(source, dest, pool):
+    with zipfile.ZipFile(source) as z:
+        members = z.infolist()
+
+    files = []
+    for info in members:
+        target = member_path(dest, info.filename)
+        if info.is_dir():
+            os.makedirs(target, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            files.append((info, target))
+
+    # Each worker thread reuses its own handle on the archive instead of
+    # parsing the central directory once per member.
+    local = threading.local()
+    handles = []
+
+    def extract_member(info, target):
+        if (z := getattr(local, "zip", None)) is None:
+            z = local.zip = zipfile.ZipFile(source)
+            handles.append(z)
+        # Reading a member to the end checks its CRC.
+        with z.open(info) as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        os.chmod(target, (info.external_attr >> 16) & 0o777 or 0o644)
+
+    try:
+        for future in [pool.submit(extract_member, info, target) for info, target in files]:
+            future.result()
+    finally:
+        for z in handles:
+            z.close()
+
+    for info in members:
+        if info.is_dir():
+            os.chmod(member_path(dest, info.filename), (info.external_attr >> 16) & 0o777 or 0o755)
@@ -20,60 +20,158 @@
 import os
 import re
 import sys
-import zlib
+import json
+import time
+import shlex
+import random
 import socket
-import pickle
 import ctypes
+import select
 import shutil
+import zipfile
+import tempfile
+import threading
 from getpass import getuser
 from pathlib import Path
 from hashlib import sha256
 from getpass import getpass
+from concurrent.futures import ThreadPoolExecutor
 
+import delta
+import config
+import archive
+import protocol
+from protocol import Connection, keepalive
+# Whatever the server names a package, its version and its content ends up
+# in paths under the include directory and the cache, so anything the
+# server itself wouldn't accept is refused.
+from registry import NAME, VERSION, DIGEST
+
+
+CACHE = Path.home() / ".cache" / "cip"
+CACHE_SIZE = 512 << 20
+SESSION = Path.home() / ".config" / "cip" / "session"
 
-IP = input("IP: ")
-PORT = int(input("Port: "))
 
 
 def encrypt(string):
     return sha256(string.encode()).hexdigest()
 
 
-class Client:
-    header = 64
-    padding = " " * header
-    packet_size = 8192
-
+def skip(pieces, offset, digest):
+    for piece in pieces:
+        digest.update(piece)
+        if offset >= len(piece):
+            offset -= len(piece)
+            continue
+        yield memoryview(piece)[offset:]
+        offset = 0
+
+
+def tee(pieces, f):
+    for piece in pieces:
+        f.write(piece)
+        yield piece
+
+
+def make_patch(base, digest, source, size, dest):
+    if size < delta.MIN_SIZE:
+        return None
+    with open(base, "rb") as f:
+        sig = delta.signature(delta.chunks(f), delta.block_size(os.path.getsize(base)))
+    with open(source, "rb") as src, open(dest, "wb") as out:
+        if not delta.related(sig, src, size) or delta.diff(sig, digest, delta.chunks(src), size, out, delta.budget(size)) is None:
+            return None
+    return dest
+
+
+def file_digest(path):
+    digest = sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Cache:
+    def __init__(self, root, limit):
+        self.root = Path(root)
+        self.limit = limit
+        self.lock = threading.Lock()
+        # Entries the server was told about and is counting on, which another
+        # package finishing first mustn't evict.
+        self.kept = set()
+
+    def entries(self):
+        return self.root.glob("*/*/*")
+
+    def digests(self):
+        cached = {}
+        for entry in self.entries():
+            cached.setdefault(entry.parent.parent.name, []).append(entry.name)
+        return cached
+
+    def get(self, package, digest):
+        for entry in self.root.glob(f"{package}/*/{digest}"):
+            os.utime(entry)
+            return entry
+
+    def keep(self, digests):
+        with self.lock:
+            self.kept.update(digests)
+
+    def put(self, package, version, digest, source):
+        path = self.root / package / version / digest
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{digest}.tmp")
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for entry in self.entries():
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries):
+                if total <= self.limit:
+                    break
+                if entry.name in self.kept:
+                    continue
+                entry.unlink(missing_ok=True)
+                total -= size
+                for parent in (entry.parent, entry.parent.parent):
+                    try:
+                        parent.rmdir()
+                    except OSError:
+                        break
+
+
+class Client(Connection):
     def __init__(self, ip, port):
-        self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.conn.connect((ip, port))
-
-    def send(self, obj):
-        data = zlib.compress(pickle.dumps(obj))
-        len_msg = (str(len(data)) + self.padding)[:self.header].encode()
-
-        packets = []
-        while data:
-            curr_len = min(len(data), self.packet_size)
-            packets.append(data[:curr_len])
-            data = data[curr_len:]
-
-        self.conn.send(len_msg)
-        for packet in packets:
-            self.conn.send(packet)
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.connect((ip, port))
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        keepalive(conn)
+        super().__init__(conn)
+        self.greet()
+
+    def closed(self):
+        # Between commands the server has nothing to say, so a socket with
+        # something to read and nothing in it is one the server hung up on.
+        try:
+            return bool(select.select([self.conn], [], [], 0)[0]) and not self.conn.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
 
     def recv(self):
-        len_msg = b""
-        while len(len_msg) < self.header:
-            len_msg += self.conn.recv(self.header-len(len_msg))
-
-        length = int(len_msg)
-        data = b""
-        while len(data) < length:
-            curr_len = min(self.packet_size, length-len(data))
-            data += self.conn.recv(curr_len)
-
-        data = pickle.loads(zlib.decompress(data))
+        data = super().recv()
         if data["type"] == "force_quit":
             print("The server has sent a command to force quit.")
             print("This could be because the server is shutting down.")
@@ -82,60 +180,301 @@ class Client:
         return data
 
 
+class Remote:
+    # Stands in for the connection until a command actually talks to the
+    # server, so local commands never connect and a shell keeps using the one
+    # connection it opened first. Of several servers the first one that
+    # answers is used, and a mirror can send the client on to its primary.
+    # A busy server is asked again after the time it suggests, with some
+    # jitter so clients turned away together don't all come back together.
+    redirects = 4
+    retries = 8
+    max_backoff = 30
+
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self.client = None
+        self.last = None
+
+    def connect(self, endpoints):
+        errors = []
+        for host, port in endpoints:
+            try:
+                self.client = Client(host, port)
+                return self.client
+            except OSError as e:
+                errors.append(f"Could not connect to {host}:{port}: {e.strerror or e}")
+        print("\n".join(errors))
+        sys.exit(1)
+
+    def __getattr__(self, name):
+        return getattr(self.client or self.connect(self.endpoints), name)
+
+    def send(self, obj):
+        self.last = obj
+        (self.client or self.connect(self.endpoints)).send(obj)
+
+    def recv(self):
+        reply = (self.client or self.connect(self.endpoints)).recv()
+        # Writes, and blobs a mirror hasn't pulled yet, are answered by its
+        # primary. The command is sent again there and the rest of the
+        # session stays with it.
+        for _ in range(self.redirects):
+            if not reply.get("primary") or self.last is None:
+                break
+            self.close()
+            self.connect([tuple(reply["primary"])]).send(self.last)
+            reply = self.client.recv()
+
+        for attempt in range(self.retries):
+            if reply.get("reply") != "busy" or self.last is None:
+                break
+            wait = min(self.max_backoff, max(reply.get("retry", 1), 0.1 * 2 ** attempt)) * random.uniform(1, 1.5)
+            print(f"The server is busy, trying again in {wait:.1f}s...")
+            time.sleep(wait)
+            self.client.send(self.last)
+            reply = self.client.recv()
+        return reply
+
+    def refresh(self):
+        # The server closes connections that sat idle, a shell left alone
+        # for a while just connects again for its next command.
+        if self.client is not None and self.client.closed():
+            self.client.conn.close()
+            self.client = None
+
+    def close(self):
+        if self.client is not None:
+            self.client.send({"type": "quit"})
+            self.client.conn.close()
+            self.client = None
+
+
 def print_help():
     print("cip - The C++ Package Installer")
     print("usage: cip [cmd] [cmd options] [-h --help] [-ls --list]\n")
     print("cip install <package name>                          Install the latest version of a package")
     print("cip install <package name>=<version>                Install the specified version of a package")
+    print("cip install '<package name><range>'                 Install the highest version matching a range (^1.2, ~2.0, >=1,<3)")
+    print("cip install <package> <package>=<version> ...       Install several packages and their dependencies at once")
+    print("cip install -r <requirements file>                  Install every package listed in a requirements file")
     print("cip uninstall <package name>                        Uninstall a package")
     print("cip upload <package name> <package path>            Upload your package for everyone to use")
-    print("cip user <username> <-c --create> <-d --delete>     Get info about a user. Provide -c or --create flag for creating user\n")
+    print("cip search <query> [-p --page <page>]               Search package names, owners and descriptions")
+    print("cip stats                                           Show server statistics")
+    print("cip user <username> <-c --create> <-d --delete>     Get info about a user. Provide -c or --create flag for creating user")
+    print("cip shell                                           Run several commands over one connection, one per line\n")
     print("Additions:")
     print("    -h --help")
     print("         Print this menu")
     print("    -ls --list")
     print("         List all possible commands")
+    print("    --host <host[:port],...> --port <port>")
+    print("         Server to talk to, overrides CIP_HOST, CIP_PORT and ~/.config/cip/config")
+    print("         With several, each is tried in turn until one answers")
+    print("    --compression <none|zlib|lz4|zstd> --compression-level <level>")
+    print("         How messages are compressed, lz4 and zstd need their Python packages")
 
 
-def install(conn, args):
-    if args:
-        if "=" in args[0]:
-            package, version = filter(lambda x: x, args[0].split("="))
-        else:
-            package, version = args[0], "RECENT"
+def load_sessions():
+    try:
+        with open(SESSION) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
 
-        conn.send({"type": "install", "package": package, "version": version})
-        content = conn.recv()["reply"]
-        if isinstance(content, str):
-            print(content)
-        else:
-            print("Creating path...")
-            if sys.platform == "windows":
-                raise NotImplementedError("Currently windows is not supported for installation.")
-                path = ""
-            elif sys.platform == "darwin":
-                raise NotImplementedError("Currently macos is not supported for installation.")
-                path = ""
-            else:
-                if getuser() != "root":
-                    raise PermissionError("You need to be root to install packages")
-                path = "/usr/include/c++/9"
 
-            print("Writing package...")
+def load_session(username):
+    return load_sessions().get(username)
 
-            with open(os.path.join(path, package), "wb") as f:
-                f.write(content)
 
-            print("Changing permissions...")
+def save_session(username, token):
+    sessions = load_sessions()
+    sessions[username] = token
+    SESSION.parent.mkdir(parents=True, exist_ok=True)
+    with open(os.open(SESSION, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+        json.dump(sessions, f)
 
-            if sys.platform == "windows":
-                raise NotImplementedError("Currently windows is not supported for installation.")
-            elif sys.platform == "darwin":
-                raise NotImplementedError("Currently macos is not supported for installation.")
-            else:
-                os.system(f"chmod +x {os.path.join(path, package)}")
 
-            print(f"Successfully installed {package}")
+def login(conn, username):
+    if (token := load_session(username)) is not None:
+        conn.send({"type": "session", "username": username, "token": token})
+        if conn.recv()["reply"]:
+            return token
+
+    for i in range(3):
+        password = encrypt(getpass(f"(Attempt {i+1}/3) Password: "))
+        conn.send({"type": "session", "username": username, "password": password})
+        if token := conn.recv()["reply"]:
+            save_session(username, token)
+            return token
+        print("Incorrect password")
+
+    print("3 attempts failed. Try again next time.")
+
+
+def input_version():
+    version = input("Version: ")
+    while VERSION.fullmatch(version) is None:
+        print(f"Invalid version {version}")
+        version = input("Version: ")
+    return version
+
+
+def parse_spec(spec):
+    package, version = re.match(r"([^=<>^~\s]+)\s*(.*)", spec).groups()
+    if version.startswith("=") and not version.startswith("=="):
+        version = version[1:]
+    return [package, version or "RECENT"]
+
+
+def read_requirements(path):
+    specs = []
+    with open(path) as f:
+        for line in f:
+            if line := line.split("#")[0].strip():
+                specs.append(parse_spec(line))
+    return specs
+
+
+def valid_entry(entry):
+    digests = [entry["digest"]] + ([entry["patch"]] if entry.get("patch") else [])
+    return NAME.fullmatch(entry["package"]) is not None and VERSION.fullmatch(entry["version"]) is not None and \
+        all(DIGEST.fullmatch(digest) is not None for digest in digests)
+
+
+def include_path():
+    if sys.platform == "windows":
+        raise NotImplementedError("Currently windows is not supported for installation.")
+    elif sys.platform == "darwin":
+        raise NotImplementedError("Currently macos is not supported for installation.")
+    else:
+        if getuser() != "root":
+            raise PermissionError("You need to be root to install packages")
+        return "/usr/include/c++/9"
+
+
+def finish_install(path, entry, part, cache, pool):
+    package = entry["package"]
+    if entry["cached"]:
+        if (cached := cache.get(package, entry["digest"])) is None:
+            return f"Cached copy of {package} disappeared while installing it. Try again."
+        shutil.copyfile(cached, part)
+    elif entry.get("patch"):
+        patch = part[:-5] + ".patch"
+        try:
+            if (base := cache.get(package, entry["patch"])) is None:
+                return f"Cached copy of {package} disappeared while patching it. Try again."
+            with open(base, "rb") as b, open(patch, "rb") as d, open(part, "wb") as f:
+                delta.apply(b, d, f)
+        except delta.DeltaError as e:
+            return f"Could not patch {package}: {e}"
+        finally:
+            os.remove(patch)
+
+    if file_digest(part) != entry["digest"]:
+        os.remove(part)
+        if entry["cached"]:
+            (cache.root / package / entry["version"] / entry["digest"]).unlink(missing_ok=True)
+            return f"Cached copy of {package} was corrupt and has been removed. Try again."
+        return f"Downloaded package {package} is corrupt. Try again next time."
+
+    if not entry["cached"]:
+        cache.put(package, entry["version"], entry["digest"], part)
+
+    target = os.path.join(path, package)
+    if zipfile.is_zipfile(part):
+        staging = tempfile.mkdtemp(prefix=f".{package}.", suffix=".staging", dir=path)
+        try:
+            archive.extract(part, staging, pool)
+        except (zipfile.BadZipFile, OSError) as e:
+            shutil.rmtree(staging, ignore_errors=True)
+            return f"Could not extract {package}: {e}"
+        finally:
+            os.remove(part)
+        os.chmod(staging, 0o755)
+        replace(staging, target)
+    else:
+        os.chmod(part, os.stat(part).st_mode | 0o111)
+        replace(part, target)
+
+    return f"Successfully installed {package}"
+
+
+def replace(source, target):
+    if os.path.lexists(target) and (os.path.isdir(source) or os.path.isdir(target)):
+        # A directory can't be renamed over another one, so move the old
+        # install aside first and only delete it once the new one is in place.
+        old = tempfile.mkdtemp(prefix=os.path.basename(target) + ".", suffix=".old", dir=os.path.dirname(target))
+        os.rename(target, os.path.join(old, "package"))
+        os.rename(source, target)
+        shutil.rmtree(old)
+    else:
+        os.replace(source, target)
+
+
+def install(conn, args):
+    specs = []
+    args = iter(args)
+    for arg in args:
+        if arg in ("-r", "--requirement"):
+            specs.extend(read_requirements(next(args)))
+        else:
+            specs.append(parse_spec(arg))
+
+    if specs:
+        print("Creating path...")
+        path = include_path()
+
+        partials = {}
+        for part in Path(path).glob(".*.part"):
+            package, digest = part.name[1:-5].rsplit(".", 1)
+            partials[package] = [digest, part.stat().st_size]
+
+        cache = Cache(CACHE, CACHE_SIZE)
+        conn.send({"type": "batch", "packages": specs, "partials": partials, "cached": cache.digests()})
+        reply = conn.recv()
+        if reply["reply"] != "success":
+            print(reply["reply"])
+            return
+        for entry in reply["packages"]:
+            if not valid_entry(entry):
+                # Nothing has been written yet. The packages the server is
+                # about to send are never read, the connection goes instead.
+                print(f"The server sent an invalid package {entry['package']!r}={entry['version']!r}, "
+                      "nothing was installed")
+                conn.close()
+                return
+        cache.keep(entry["digest"] if entry["cached"] else entry["patch"]
+                   for entry in reply["packages"] if entry["cached"] or entry.get("patch"))
+
+        with ThreadPoolExecutor() as pool, ThreadPoolExecutor() as extract_pool:
+            results = []
+            for entry in reply["packages"]:
+                package = entry["package"]
+                if package in partials and partials[package][0] != entry["digest"]:
+                    os.remove(os.path.join(path, f".{package}.{partials[package][0]}.part"))
+                part = os.path.join(path, f".{package}.{entry['digest']}.part")
+
+                if entry["cached"]:
+                    print(f"Using cached {package}={entry['version']}")
+                elif entry.get("patch"):
+                    print(f"Downloading changes to {package}={entry['version']} ({entry['size']} bytes)...")
+                elif entry["offset"]:
+                    print(f"Resuming {package}={entry['version']} at {entry['offset']} of {entry['size']} bytes...")
+                else:
+                    print(f"Downloading {package}={entry['version']}...")
+
+                if entry.get("patch"):
+                    with open(part[:-5] + ".patch", "wb") as f:
+                        conn.recv_stream(f)
+                elif not entry["cached"]:
+                    with open(part, "r+b" if entry["offset"] else "wb") as f:
+                        conn.recv_stream(f, entry["offset"])
+                results.append(pool.submit(finish_install, path, entry, part, cache, extract_pool))
+
+            for result in results:
+                print(result.result())
 
 
 def uninstall(conn, args):
@@ -161,61 +500,169 @@ def uninstall(conn, args):
 def upload(conn, args):
     if args:
         pack_name = args[0]
-        while re.search(re.compile(r"[a-zA-Z0-9-]+"), pack_name) is None:
+        while NAME.fullmatch(pack_name) is None:
             print(f"Invalid package name {pack_name}")
             pack_name = input("Package name: ")
 
         username = input("Username: ")
-        conn.send({"type": "user", "method": "verify", "username": username})
-        while conn.recv()["reply"] == "success":
-            print(f"User {username} does not exist")
-            username = input("Username: ")
-            conn.send({"type": "user", "method": "verify", "username": username})
+        version = input_version()
+        dependencies = [parse_spec(dep) for dep in input("Dependencies (space separated, blank for none): ").split()]
+        description = input("Description (blank to keep the current one): ")
+
+        # Every check the upload needs goes to the server in one request, and
+        # only the answers that came back wrong are asked for again.
+        token = load_session(username)
+        password = None
+        attempts = 0
+        while True:
+            if token is None and password is None:
+                if attempts == 3:
+                    print("3 attempts failed. Try again next time.")
+                    return
+                attempts += 1
+                password = encrypt(getpass(f"(Attempt {attempts}/3) Password: "))
+
+            conn.send({"type": "preflight", "username": username, "package": pack_name, "version": version,
+                       "token": token, "password": password})
+            reply = conn.recv()
+            if reply["user"] and reply["auth"] and reply["package"] and reply["version"]:
+                token = reply["token"]
+                break
 
-        conn.send({"type": "package", "package": pack_name, "user": username})
-        while conn.recv()["reply"]:
-            print(f"Package {pack_name} already exists")
-            pack_name = input("Package Name: ")
-            conn.send({"type": "package", "package": pack_name, "user": username})
+            if not reply["user"]:
+                print(f"User {username} does not exist")
+                username = input("Username: ")
+                token = load_session(username)
+                password = None
+                attempts = 0
+            elif not reply["auth"]:
+                if token is None:
+                    print("Incorrect password")
+                token = password = None
+            elif token is None:
+                token = reply["token"]
+
+            if not reply["package"]:
+                print(f"Package {pack_name} already exists")
+                pack_name = input("Package Name: ")
+            elif not reply["version"]:
+                print(f"Version {version} already exists")
+                version = input_version()
+
+        save_session(username, token)
+
+        print("Authentication successful")
+        cache = Cache(CACHE, CACHE_SIZE)
+        base = cache.get(pack_name, reply["base"]) if reply["base"] else None
+        with tempfile.TemporaryDirectory() as scratch:
+            # Whatever gets uploaded is kept in the cache, so the next version
+            # can be sent as a patch against it.
+            source = args[1]
+            copy = os.path.join(scratch, "package.zip")
+            if os.path.isdir(source) and base is not None:
+                # The archive has to exist in full to be compared with the
+                # previous version.
+                print("Compressing package...")
+                with open(copy, "wb") as f:
+                    for piece in archive.build(source):
+                        f.write(piece)
+                source = copy
+
+            if os.path.isdir(source):
+                # Archives are built deterministically while they are sent, so the
+                # digest only exists once the last byte went out. A resumed upload
+                # rebuilds the same bytes and skips what the server already has.
+                print("Compressing and uploading package...")
+                conn.send({"type": "upload", "user": username, "package": pack_name, "version": version,
+                           "size": None, "digest": None, "dependencies": dependencies, "description": description, "token": token})
+                reply = conn.recv()
+                if reply["reply"] != "ready":
+                    print(reply["reply"])
+                    return
+                if offset := reply["offset"]:
+                    print(f"Resuming upload at {offset} bytes...")
+
+                digest = sha256()
+                with open(copy, "wb") as f:
+                    conn.send_pieces(skip(tee(archive.build(source), f), offset, digest), offset)
+                digest = digest.hexdigest()
+                conn.send({"type": "digest", "digest": digest})
+
+            elif os.path.isfile(source):
+                size = os.path.getsize(source)
+                digest = file_digest(source)
+                cmd = {"type": "upload", "user": username, "package": pack_name, "version": version, "size": size,
+                       "digest": digest, "dependencies": dependencies, "description": description, "token": token}
+                patch = make_patch(base, base.name, source, size, os.path.join(scratch, "package.patch")) if base else None
+                if patch is not None:
+                    cmd["patch"] = base.name
+                conn.send(cmd)
+                reply = conn.recv()
+                if reply["reply"] != "ready":
+                    print(reply["reply"])
+                    return
+                if offset := reply["offset"]:
+                    print(f"Resuming upload at {offset} of {os.path.getsize(patch or source)} bytes...")
+                print("Uploading changes since the previous version..." if patch else "Uploading package...")
+                with open(patch or source, "rb") as f:
+                    conn.send_stream(f, offset)
+                copy = source
 
-        for i in range(3):
-            password = encrypt(getpass(f"(Attempt {i+1}/3) Password: "))
-            conn.send({"type": "auth", "username": username, "password": password})
-            if conn.recv()["reply"]:
-                break
-            print("Incorrect password")
-        else:
-            print("3 attempts failed. Try again next time.")
-            return
+            else:
+                print("Not a valid path.")
+                return
 
-        version = input("Version: ")
-        conn.send({"type": "version", "package": pack_name, "version": version})
-        while conn.recv()["reply"]:
-            print(f"Version {version} already exists")
-            version = input("Version: ")
-            conn.send({"type": "version", "package": pack_name, "version": version})
-
-
-        print("Password authentication successful")
-        print("Compressing data...")
-        if os.path.isdir(args[1]):
-            tmp = Path.home() / "Downloads/cip-tmp.zip"
-            shutil.make_archive(os.path.splitext(tmp)[0], "zip", args[1])
-            with open(tmp, "rb") as f:
-                content = f.read()
-            os.remove(tmp)
-        elif os.path.isfile(args[1]):
-            with open(args[1], "r") as f:
-                content = f.read().encode()
-        else:
-            print("Not a valid path.")
-            return
-        print("Uploading package...")
-        conn.send({"type": "upload", "user": username, "package": pack_name, "version": version, "content": content})
-        if conn.recv()["reply"] == "success":
-            print("Successfully uploaded")
+            if conn.recv()["reply"] == "success":
+                cache.put(pack_name, version, digest, copy)
+                print("Successfully uploaded")
+            else:
+                print("Upload failed... Try again next time")
+
+
+def search(conn, args):
+    page = 1
+    words = []
+    args = iter(args)
+    for arg in args:
+        if arg in ("-p", "--page"):
+            page = next(args, "1")
+            if not page.isdigit() or not int(page):
+                print(f"Invalid page {page}")
+                return
+            page = int(page)
         else:
-            print("Upload failed... Try again next time")
+            words.append(arg)
+
+    if not words:
+        print("Nothing to search for")
+        return
+
+    conn.send({"type": "search", "query": " ".join(words), "page": page})
+    reply = conn.recv()
+    if "total" not in reply:
+        print(reply["reply"])
+        return
+    if not reply["total"]:
+        print(f"No packages found for {' '.join(words)}")
+        return
+
+    for name, version, owner, description in reply["reply"]:
+        print(f"{name} {version} by {owner}" + (f" - {description}" if description else ""))
+    print(f"Page {reply['page']} of {reply['pages']} ({reply['total']} packages)")
+
+
+def stats(conn, args):
+    conn.send({"type": "stats"})
+    stats = conn.recv()["reply"]
+    print(f"Uptime: {stats['uptime']:.0f}s")
+    print(f"Connections: {stats['connections']} open, {stats['accepted']} accepted")
+    print(f"Traffic: {stats['bytes_received']} bytes in, {stats['bytes_sent']} bytes out")
+    for name, command in sorted(stats["commands"].items()):
+        phases = ", ".join(f"{phase} {seconds / command['count'] * 1000:.3f}" for phase, seconds in command["phases"].items())
+        print(f"{name}: {command['count']} requests, {command['seconds'] / command['count'] * 1000:.3f}ms average ({phases})")
+    for section in ("hot_cache", "registry", "limits"):
+        if section in stats:
+            print(f"{section}: " + ", ".join(f"{key} {value}" for key, value in stats[section].items()))
 
 
 def user(conn, args):
@@ -253,18 +700,11 @@ def user(conn, args):
                 username = input("Username: ")
                 conn.send({"type": "user", "method": "verify", "username": username})
 
-            for i in range(3):
-                password = encrypt(getpass(f"(Attempt {i+1}/3) Password: "))
-                conn.send({"type": "auth", "username": username, "password": password})
-                if conn.recv()["reply"]:
-                    break
-                print("Incorrect password")
-            else:
-                print("3 attempts failed. Try again next time.")
+            if (token := login(conn, username)) is None:
                 return
             if "y" in input(f"Are you sure you want to delete {username}? [y/n] ").lower():
                 print("Deleting user from server...")
-                conn.send({"type": "user", "user": username, "method": "delete"})
+                conn.send({"type": "user", "user": username, "method": "delete", "token": token})
                 if conn.recv()["reply"] == "success":
                     print(f"{username} got deleted")
                 else:
@@ -275,31 +715,67 @@ def user(conn, args):
             print(conn.recv()["reply"])
 
 
-def main():
-    conn = Client(IP, PORT)
-    funcs = {
-        "install": install,
-        "uninstall": uninstall,
-        "upload": upload,
-        "user": user,
-    }
-
-    if len(sys.argv) == 1:
+def shell(conn, args):
+    print("cip shell: one command per line, exit or end of input to leave")
+    while True:
+        try:
+            line = input("cip> ")
+        except EOFError:
+            print()
+            break
+        try:
+            argv = shlex.split(line)
+        except ValueError as e:
+            print(e)
+            continue
+        if not argv:
+            continue
+        if argv[0] in ("exit", "quit"):
+            break
+        if argv[0] == "shell":
+            print("Already in a shell")
+            continue
+        conn.refresh()
+        run(conn, argv)
+
+
+COMMANDS = {
+    "install": install,
+    "uninstall": uninstall,
+    "upload": upload,
+    "search": search,
+    "stats": stats,
+    "user": user,
+    "shell": shell,
+}
+
+
+def run(conn, argv):
+    if "-h" in argv or "--help" in argv:
         print_help()
+    elif "-ls" in argv or "--list" in argv:
+        print("Possible commands:")
+        for f in COMMANDS.keys():
+            print(f)
+    elif argv[0] in COMMANDS:
+        COMMANDS[argv[0]](conn, argv[1:])
     else:
-        if "-h" in sys.argv or "--help" in sys.argv:
-            print_help()
-        elif "-ls" in sys.argv or "--list" in sys.argv:
-            print("Possible commands:")
-            for f in funcs.keys():
-                print(f)
-        else:
-            if sys.argv[1] in funcs:
-                funcs[sys.argv[1]](conn, sys.argv[2:])
-            else:
-                print(f"Unrecognized command {sys.argv[1]}.")
+        print(f"Unrecognized command {argv[0]}.")
+
+
+def main():
+    settings, argv = config.load("client", sys.argv[1:], ("host", "port", "compression", "compression_level"))
+    protocol.configure(settings.get("compression"), settings.get("compression_level"))
+    if not argv:
+        print_help()
+        return
 
-    conn.send({"type": "quit"})
+    conn = Remote(config.endpoints(settings["host"], settings["port"]))
+    try:
+        run(conn, argv)
+    finally:
+        conn.close()
 
 
-main()
+if __name__ == "__main__":
+    main()
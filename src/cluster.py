@@ -0,0 +1,109 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+
+import os
+import itertools
+import threading
+
+
+class RemoteError(Exception):
+    # A write the coordinator made for a worker failed there.
+    pass
+
+
+class Coordinator:
+    # Runs in the parent process of a pre-forked server. It owns the journal
+    # and is the only process that changes the registry, workers send it
+    # their writes and get every change it makes streamed back to them.
+    def __init__(self, server):
+        self.server = server
+        self.links = []
+
+    def add(self, conn):
+        link = (conn, threading.Lock())
+        self.links.append(link)
+        threading.Thread(target=self.serve, args=(link,), daemon=True).start()
+
+    def broadcast(self, message):
+        for conn, lock in self.links:
+            with lock:
+                conn.send(message)
+
+    def serve(self, link):
+        conn, _ = link
+        while True:
+            try:
+                call, method, args = conn.recv()
+            except (EOFError, OSError):
+                return
+            # Each call gets a thread so writes from different workers can
+            # still share a journal fsync.
+            threading.Thread(target=self.run, args=(link, call, method, args), daemon=True).start()
+
+    def run(self, link, call, method, args):
+        # The worker waits for an answer either way, without one its
+        # connection would hang and keep whatever slot it holds.
+        try:
+            message = ("reply", call, getattr(self.server, method)(*args))
+        except Exception as e:
+            print(f"[SERVER] {method} failed for a worker: {e!r}")
+            message = ("error", call, repr(e))
+        conn, lock = link
+        with lock:
+            conn.send(message)
+
+
+class Link:
+    # A worker's end of its pipe to the coordinator. Changes and replies
+    # arrive on the same pipe in the order the coordinator made them, so by
+    # the time a write returns the worker's registry already has it.
+    def __init__(self, conn, replicate):
+        self.conn = conn
+        self.replicate = replicate
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.ids = itertools.count()
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def call(self, method, *args):
+        call = next(self.ids)
+        waiter = self.calls[call] = [threading.Event(), None, None]
+        with self.lock:
+            self.conn.send((call, method, args))
+        waiter[0].wait()
+        del self.calls[call]
+        if waiter[2] is not None:
+            raise RemoteError(f"{method} failed: {waiter[2]}")
+        return waiter[1]
+
+    def listen(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                print(f"[WORKER {os.getpid()}] Lost the coordinator, stopping")
+                os._exit(1)
+
+            if message[0] in ("reply", "error"):
+                waiter = self.calls[message[1]]
+                waiter[1 if message[0] == "reply" else 2] = message[2]
+                waiter[0].set()
+            else:
+                self.replicate(message)
@@ -0,0 +1,94 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+from pathlib import Path
+from configparser import ConfigParser
+
+CONFIG = Path.home() / ".config" / "cip" / "config"
+
+DEFAULTS = {
+    "host": "127.0.0.1",
+    "port": "5000",
+}
+
+ENVIRONMENT = {
+    "host": "CIP_HOST",
+    "port": "CIP_PORT",
+    "data": "CIP_DATA",
+}
+
+TRUE = ("1", "true", "yes", "on")
+
+
+def load(section, argv, options=(), switches=()):
+    # Later sources win: built in defaults, the config file (its [DEFAULT]
+    # part, then the client or server section), environment variables and
+    # finally command line flags. Flags can sit anywhere in argv, whatever
+    # isn't one of them is handed back for the command itself.
+    settings = dict(DEFAULTS)
+    parser = ConfigParser()
+    parser.read(os.environ.get("CIP_CONFIG", CONFIG))
+    settings.update(parser.defaults())
+    if parser.has_section(section):
+        settings.update(parser[section])
+
+    for key, name in ENVIRONMENT.items():
+        if name in os.environ:
+            settings[key] = os.environ[name]
+
+    rest = []
+    args = iter(argv)
+    for arg in args:
+        key, has_value, value = arg[2:].partition("=")
+        # --compression-level sets the compression_level config key.
+        key = key.replace("-", "_")
+        if arg.startswith("--") and key in options:
+            if not has_value and (value := next(args, None)) is None:
+                raise SystemExit(f"{arg} needs a value")
+            settings[key] = value
+        elif arg.startswith("--") and key in switches:
+            settings[key] = value if has_value else "true"
+        else:
+            rest.append(arg)
+    return settings, rest
+
+
+def enabled(settings, key):
+    return str(settings.get(key, "")).lower() in TRUE
+
+
+def address(settings):
+    try:
+        return settings["host"], int(settings["port"])
+    except ValueError:
+        raise SystemExit(f"Invalid port {settings['port']}") from None
+
+
+def endpoints(hosts, port):
+    # One or more servers separated by commas, each a host with an optional
+    # port, in the order they're to be tried.
+    found = []
+    for entry in hosts.split(","):
+        host, _, number = entry.strip().partition(":")
+        try:
+            found.append((host, int(number or port)))
+        except ValueError:
+            raise SystemExit(f"Invalid port {number or port}") from None
+    return found
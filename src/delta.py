@@ -0,0 +1,315 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import math
+import zlib
+import struct
+from hashlib import blake2b
+
+# A delta rebuilds a target file from a base file that the other side
+# already has. It is a header naming the base and the size of the result,
+# followed by operations that either copy a range of the base or insert
+# literal bytes, and a final END operation.
+HEAD = struct.Struct("!4s32sQ")
+COPY = struct.Struct("!BQI")
+LITERAL = struct.Struct("!BI")
+MAGIC = b"CIPD"
+OP_COPY = 0
+OP_LITERAL = 1
+OP_END = 2
+
+MOD = 65521
+MAX_OP = 0xFFFFFFFF
+CHUNK = 1 << 20
+
+# Smaller files aren't worth keeping or sending as deltas.
+MIN_SIZE = 1 << 16
+
+# Windows of the target sampled before committing to a whole diff.
+PROBES = 8
+
+# Rolling through unmatched bytes is the slow part, a stretch this long
+# without a single match means the files have little in common left.
+MAX_GAP = 1 << 22
+
+
+class DeltaError(Exception):
+    pass
+
+
+def block_size(size):
+    # rsync's rule of thumb, about the square root of the file size.
+    return min(1 << 16, max(1 << 11, 1 << int(math.log2(math.isqrt(size) or 1))))
+
+
+def budget(size):
+    # A delta that doesn't at least halve the transfer isn't worth the
+    # trouble of applying it.
+    return size // 2
+
+
+def weak(block):
+    # Adler-32 is the same kind of rolling checksum rsync uses: a is one plus
+    # the sum of the bytes, b weights every byte by its distance from the end
+    # of the block. zlib computes it in C, only rolling it happens here.
+    value = zlib.adler32(block)
+    return value & 0xFFFF, value >> 16
+
+
+def strong(block):
+    return blake2b(block, digest_size=16).digest()
+
+
+def chunks(f, offset=0):
+    f.seek(offset)
+    while chunk := f.read(CHUNK):
+        yield chunk
+
+
+class Signature:
+    def __init__(self, block):
+        self.block = block
+        self.weak = set()
+        self.strong = {}
+
+
+def signature(pieces, block):
+    sig = Signature(block)
+    buffer = bytearray()
+    offset = 0
+
+    def add(data):
+        a, b = weak(data)
+        sig.weak.add(a | b << 16)
+        sig.strong.setdefault(strong(data), (offset, len(data)))
+
+    for piece in pieces:
+        buffer += piece
+        start = 0
+        while len(buffer) - start >= block:
+            add(buffer[start:start+block])
+            offset += block
+            start += block
+        del buffer[:start]
+    if buffer:
+        add(buffer)
+    return sig
+
+
+class Writer:
+    def __init__(self, out, base, size):
+        self.out = out
+        self.written = 0
+        self.copy = None
+        self.write(HEAD.pack(MAGIC, bytes.fromhex(base), size))
+
+    def write(self, data):
+        self.out.write(data)
+        self.written += len(data)
+
+    def add_copy(self, offset, length):
+        # Consecutive blocks of the base collapse into one operation.
+        if self.copy is not None and self.copy[0] + self.copy[1] == offset and self.copy[1] + length <= MAX_OP:
+            self.copy[1] += length
+            return
+        self.flush()
+        self.copy = [offset, length]
+
+    def add_literal(self, data):
+        self.flush()
+        for start in range(0, len(data), MAX_OP):
+            piece = data[start:start+MAX_OP]
+            self.write(LITERAL.pack(OP_LITERAL, len(piece)))
+            self.write(piece)
+
+    def flush(self):
+        if self.copy is not None:
+            self.write(COPY.pack(OP_COPY, *self.copy))
+            self.copy = None
+
+    def close(self):
+        self.flush()
+        self.write(bytes([OP_END]))
+        return self.written
+
+
+def related(sig, f, size):
+    """
+    Whether one of a few windows spread over the target shares a block with
+    the base. Finding that out takes a fraction of the time a diff needs to
+    give up on two files that have nothing in common.
+    """
+    block = sig.block
+    if size <= PROBES * 2 * block:
+        return True
+
+    for i in range(PROBES):
+        f.seek(size * i // PROBES)
+        window = f.read(2 * block)
+        a, b = weak(window[:block])
+        for pos in range(len(window) - block):
+            if a | b << 16 in sig.weak and strong(window[pos:pos+block]) in sig.strong:
+                return True
+            out_byte, in_byte = window[pos], window[pos+block]
+            a = (a - out_byte + in_byte) % MOD
+            b = (b - block * out_byte + a - 1) % MOD
+    return False
+
+
+def diff(sig, base, pieces, size, out, limit=None):
+    """
+    Write a delta from the base the signature was made of to the target
+    given as pieces, return its length or None if more than limit bytes of
+    the target had no match in the base, or too long a stretch in one go.
+
+    Unchanged stretches are found by hashing whole blocks, which runs at
+    the speed of the hash. Only once a block doesn't match does the window
+    roll forward a byte at a time until it finds its way back into the base.
+    """
+    block = sig.block
+    writer = Writer(out, base, size)
+    pieces = iter(pieces)
+    buffer = bytearray()
+    pos = pending = 0
+    literals = gap = 0
+    rolling = None
+    done = False
+
+    while True:
+        while not done and len(buffer) - pos <= block:
+            if (piece := next(pieces, None)) is None:
+                done = True
+            else:
+                buffer += piece
+        if pos >= len(buffer):
+            break
+
+        end = min(pos + block, len(buffer))
+        match = None
+        if rolling is None:
+            match = sig.strong.get(strong(buffer[pos:end]))
+            if match is None and end - pos == block:
+                rolling = weak(buffer[pos:end])
+        elif rolling[0] | rolling[1] << 16 in sig.weak:
+            match = sig.strong.get(strong(buffer[pos:end]))
+
+        if match is not None and match[1] == end - pos:
+            if pending < pos:
+                literals += pos - pending
+                writer.add_literal(buffer[pending:pos])
+            writer.add_copy(*match)
+            pos = pending = end
+            rolling = None
+            gap = 0
+            if pos >= CHUNK:
+                del buffer[:pos]
+                pos = pending = 0
+            continue
+
+        if rolling is None or end - pos < block or end == len(buffer):
+            # Too close to the end for a whole block, the rest is literal.
+            pos = len(buffer) if done else pos + 1
+            rolling = None
+            continue
+
+        out_byte, in_byte = buffer[pos], buffer[end]
+        a = (rolling[0] - out_byte + in_byte) % MOD
+        rolling = a, (rolling[1] - block * out_byte + a - 1) % MOD
+        pos += 1
+        gap += 1
+
+        if gap > MAX_GAP:
+            return None
+        if pos - pending >= CHUNK:
+            literals += pos - pending
+            writer.add_literal(buffer[pending:pos])
+            del buffer[:pos]
+            pos = pending = 0
+        if limit is not None and literals + pos - pending > limit:
+            return None
+
+    if pending < len(buffer):
+        literals += len(buffer) - pending
+        writer.add_literal(buffer[pending:])
+    if limit is not None and literals > limit:
+        return None
+    return writer.close()
+
+
+def read_header(f):
+    head = f.read(HEAD.size)
+    if len(head) != HEAD.size:
+        raise DeltaError("Delta is cut short")
+    magic, base, size = HEAD.unpack(head)
+    if magic != MAGIC:
+        raise DeltaError("Not a delta")
+    return base.hex(), size
+
+
+def patch(base, delta, offset=0):
+    """Yield the target rebuilt from the base and delta files, from offset on."""
+    delta.seek(0)
+    read_header(delta)
+    position = 0
+    while True:
+        op = delta.read(1)
+        if not op:
+            raise DeltaError("Delta is cut short")
+
+        if op[0] == OP_END:
+            return
+        elif op[0] == OP_COPY:
+            _, start, length = COPY.unpack(op + delta.read(COPY.size - 1))
+            skip = max(0, offset - position)
+            position += length
+            if skip >= length:
+                continue
+            base.seek(start + skip)
+            length -= skip
+            while length:
+                data = base.read(min(length, CHUNK))
+                if not data:
+                    raise DeltaError("Base is shorter than the delta expects")
+                yield data
+                length -= len(data)
+        elif op[0] == OP_LITERAL:
+            _, length = LITERAL.unpack(op + delta.read(LITERAL.size - 1))
+            skip = max(0, offset - position)
+            position += length
+            if skip >= length:
+                delta.seek(length, 1)
+                continue
+            delta.seek(skip, 1)
+            length -= skip
+            while length:
+                data = delta.read(min(length, CHUNK))
+                if not data:
+                    raise DeltaError("Delta is cut short")
+                yield data
+                length -= len(data)
+        else:
+            raise DeltaError(f"Unknown delta operation {op[0]}")
+
+
+def apply(base, delta, out):
+    size = 0
+    for piece in patch(base, delta):
+        out.write(piece)
+        size += len(piece)
+    return size
@@ -0,0 +1,84 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import threading
+from collections import OrderedDict
+
+
+class HotCache:
+    def __init__(self, limit, max_item, admit_after=2):
+        self.limit = limit
+        self.max_item = max_item
+        self.admit_after = admit_after
+        self.lock = threading.Lock()
+
+        self.entries = OrderedDict()
+        self.seen = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, digest):
+        with self.lock:
+            data = self.entries.get(digest)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(digest)
+            return data
+
+    def admit(self, digest, size):
+        # Only versions that keep getting asked for are worth compressing and
+        # holding on to, a one off install shouldn't push out a popular one.
+        if size > self.max_item:
+            return False
+        with self.lock:
+            count = self.seen.pop(digest, 0) + 1
+            if count >= self.admit_after:
+                return True
+            self.seen[digest] = count
+            if len(self.seen) > 4096:
+                self.seen.popitem(last=False)
+            return False
+
+    def put(self, digest, data):
+        with self.lock:
+            if (old := self.entries.pop(digest, None)) is not None:
+                self.size -= len(old)
+            self.entries[digest] = data
+            self.size += len(data)
+
+            while self.size > self.limit:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, digest):
+        with self.lock:
+            self.seen.pop(digest, None)
+            if (old := self.entries.pop(digest, None)) is not None:
+                self.size -= len(old)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
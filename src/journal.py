@@ -0,0 +1,210 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+import gc
+import time
+import zlib
+import pickle
+import struct
+import threading
+from pathlib import Path
+
+from registry import Registry
+
+# Every log record is its sequence number, payload length and payload crc32
+# followed by the pickled (operation, arguments) pair. A record that is cut
+# short or fails its checksum marks the end of the log.
+RECORD = struct.Struct("!QII")
+
+
+class Journal:
+    batch_interval = 0.002
+    snapshot_every = 50000
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.io_lock = threading.Lock()
+        self.dirty = threading.Event()
+
+        self.pending = []
+        self.seq = 0
+        self.synced_seq = 0
+        self.snapshot_seq = 0
+        self.log = None
+        self.active = True
+
+    def segment(self, seq):
+        return self.root / f"log.{seq:020d}"
+
+    def segments(self):
+        return sorted(self.root.glob("log.*"))
+
+    def read(self, path, repair=True):
+        with open(path, "rb") as f:
+            data = f.read()
+
+        pos = 0
+        while pos + RECORD.size <= len(data):
+            seq, length, crc = RECORD.unpack_from(data, pos)
+            payload = data[pos+RECORD.size:pos+RECORD.size+length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            yield seq, pickle.loads(payload)
+            pos += RECORD.size + length
+
+        if repair and pos < len(data):
+            with open(path, "r+b") as f:
+                f.truncate(pos)
+
+    def records(self, since, until):
+        # Reads back what a mirror that has everything up to since is
+        # missing. The segment being written to may end in a record that is
+        # still on its way, so nothing is ever truncated here.
+        segments = self.segments()
+        for path, following in zip(segments, segments[1:] + [None]):
+            if following is not None and int(following.name[4:]) <= since + 1:
+                continue
+            try:
+                for seq, record in self.read(path, repair=False):
+                    if seq > until:
+                        return
+                    if seq > since:
+                        yield seq, record
+            except FileNotFoundError:
+                # Removed by a snapshot in the meantime, the caller sees the gap.
+                return
+
+    def load(self):
+        # The registry is built once and lives for the whole process, so there
+        # is nothing for the cyclic collector to find while loading it.
+        gc.disable()
+        try:
+            registry = Registry()
+            registry.defer()
+            registry.index.defer()
+            snapshot = self.root / "snapshot"
+            if snapshot.is_file():
+                with open(snapshot, "rb") as f:
+                    self.snapshot_seq, state = pickle.load(f)
+                registry.restore(state)
+
+            self.seq = self.snapshot_seq
+            for path in self.segments():
+                for seq, (op, args) in self.read(path):
+                    if seq > self.seq:
+                        getattr(registry, op)(*args)
+                        self.seq = seq
+            registry.settle()
+        finally:
+            gc.enable()
+        gc.freeze()
+        registry.index.resume()
+
+        self.synced_seq = self.seq
+        self.log = open(self.segment(self.seq + 1), "ab")
+        threading.Thread(target=self.flusher, daemon=True).start()
+        return registry
+
+    def append(self, op, args):
+        payload = pickle.dumps((op, args), pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.seq += 1
+            self.pending.append(RECORD.pack(self.seq, len(payload), zlib.crc32(payload)) + payload)
+            self.dirty.set()
+            return self.seq
+
+    def wait(self, seq):
+        with self.lock:
+            while self.synced_seq < seq and self.active:
+                self.synced.wait()
+
+    def flush(self):
+        with self.io_lock:
+            with self.lock:
+                records, self.pending = self.pending, []
+                seq = self.seq
+                self.dirty.clear()
+
+            if records:
+                self.log.write(b"".join(records))
+                self.log.flush()
+                os.fsync(self.log.fileno())
+
+        with self.lock:
+            self.synced_seq = max(self.synced_seq, seq)
+            self.synced.notify_all()
+
+    def flusher(self):
+        while self.active:
+            self.dirty.wait()
+            if not self.active:
+                return
+            # Give writers arriving at the same moment a chance to share the fsync.
+            time.sleep(self.batch_interval)
+            self.flush()
+
+    def restart(self, seq):
+        # Throws the log away and carries on from seq, for a mirror that was
+        # handed a whole registry. A snapshot at seq has to follow.
+        self.flush()
+        with self.io_lock:
+            self.log.close()
+            for path in self.segments():
+                os.remove(path)
+            with self.lock:
+                self.seq = self.synced_seq = seq
+            self.log = open(self.segment(seq + 1), "ab")
+
+    def needs_snapshot(self):
+        return self.seq - self.snapshot_seq >= self.snapshot_every
+
+    def rotate(self):
+        self.flush()
+        with self.io_lock:
+            self.log.close()
+            self.log = open(self.segment(self.seq + 1), "ab")
+            return self.seq
+
+    def save_snapshot(self, seq, data):
+        tmp = self.root / "snapshot.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.root / "snapshot")
+
+        current = self.segment(seq + 1)
+        for path in self.segments():
+            if path < current:
+                os.remove(path)
+        self.snapshot_seq = seq
+
+    def close(self):
+        self.flush()
+        self.active = False
+        self.dirty.set()
+        with self.lock:
+            self.synced.notify_all()
+        with self.io_lock:
+            self.log.close()
@@ -0,0 +1,197 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import time
+import asyncio
+import threading
+from collections import deque
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self, amount, now):
+        # Seconds until amount is there to take, 0 if it already is.
+        self.refill(now)
+        return 0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+
+class RateLimiter:
+    # Every client address and every signed in user has one bucket for
+    # requests and one for bytes. A request is let in only if each of its
+    # buckets has a token for it and isn't in debt for bytes, which are
+    # only known and charged once the request is done.
+    prune_every = 10000
+
+    def __init__(self, requests=0, request_burst=0, bandwidth=0, bandwidth_burst=0):
+        self.requests = requests
+        self.request_burst = request_burst or max(1, requests)
+        self.bandwidth = bandwidth
+        self.bandwidth_burst = bandwidth_burst or bandwidth
+        self.enabled = bool(requests or bandwidth)
+
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.checks = 0
+        self.throttled = 0
+
+    def get(self, key, now):
+        if (buckets := self.buckets.get(key)) is None:
+            buckets = self.buckets[key] = (TokenBucket(self.requests, self.request_burst, now) if self.requests else None,
+                                           TokenBucket(self.bandwidth, self.bandwidth_burst, now) if self.bandwidth else None)
+        return buckets
+
+    def admit(self, keys):
+        # Returns how long to wait before trying again, 0 when let in.
+        now = time.monotonic()
+        with self.lock:
+            self.checks += 1
+            if self.checks % self.prune_every == 0:
+                self.prune(now)
+
+            wait = 0
+            found = [self.get(key, now) for key in keys]
+            for requests, sent in found:
+                if requests is not None:
+                    wait = max(wait, requests.wait(1, now))
+                if sent is not None:
+                    wait = max(wait, sent.wait(0, now))
+            if wait:
+                self.throttled += 1
+                return wait
+            for requests, _ in found:
+                if requests is not None:
+                    requests.tokens -= 1
+            return 0
+
+    def charge(self, keys, size):
+        if not self.bandwidth:
+            return
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                bucket = self.get(key, now)[1]
+                bucket.refill(now)
+                bucket.tokens -= size
+
+    def prune(self, now):
+        # A bucket that has filled up again is the same as a new one.
+        for key, buckets in list(self.buckets.items()):
+            for bucket in buckets:
+                if bucket is not None:
+                    bucket.refill(now)
+            if all(bucket is None or bucket.tokens >= bucket.burst for bucket in buckets):
+                del self.buckets[key]
+
+    def stats(self):
+        return {"clients": len(self.buckets), "throttled": self.throttled}
+
+
+class FairQueue:
+    # Admission for expensive work. At most slots of it run at once, and
+    # whoever waits is served a turn per client in rotation, so one client
+    # with many requests queued can't push everyone else back. When depth
+    # requests are already waiting the next one is turned away.
+    def __init__(self, slots, depth):
+        self.lock = threading.Lock()
+        self.free = slots
+        self.depth = depth
+        self.waiting = {}
+        self.queued = 0
+        self.rejected = 0
+
+    def enter(self, key, wake):
+        # True when the work can start right away, None when it has to wait
+        # for wake to be called and False when the queue is full.
+        with self.lock:
+            if self.free and not self.queued:
+                self.free -= 1
+                return True
+            if self.queued >= self.depth:
+                self.rejected += 1
+                return False
+            self.waiting.setdefault(key, deque()).append(wake)
+            self.queued += 1
+            return None
+
+    def cancel(self, key, wake):
+        # False if it was too late and the turn has been handed over already.
+        with self.lock:
+            if (waiters := self.waiting.get(key)) is None or wake not in waiters:
+                return False
+            waiters.remove(wake)
+            if not waiters:
+                del self.waiting[key]
+            self.queued -= 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            if not self.waiting:
+                self.free += 1
+                return
+            # Dicts keep insertion order, so putting the client back in at
+            # the end makes everyone else waiting go first.
+            key = next(iter(self.waiting))
+            waiters = self.waiting.pop(key)
+            wake = waiters.popleft()
+            if waiters:
+                self.waiting[key] = waiters
+            self.queued -= 1
+        # The slot goes straight to the woken request, it's never freed.
+        wake()
+
+    def wait(self, key, timeout):
+        event = threading.Event()
+        if (admitted := self.enter(key, event.set)) is not None:
+            return admitted
+        return event.wait(timeout) or not self.cancel(key, event.set)
+
+    async def wait_async(self, key, timeout):
+        loop = asyncio.get_running_loop()
+        turn = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: turn.done() or turn.set_result(True))
+
+        if (admitted := self.enter(key, wake)) is not None:
+            return admitted
+        try:
+            return await asyncio.wait_for(asyncio.shield(turn), timeout)
+        except asyncio.TimeoutError:
+            return not self.cancel(key, wake)
+        except asyncio.CancelledError:
+            # Gone while waiting, a turn it was given passes on to the next.
+            if not self.cancel(key, wake):
+                self.leave()
+            raise
+
+    def stats(self):
+        with self.lock:
+            return {"free": self.free, "queued": self.queued, "rejected": self.rejected}
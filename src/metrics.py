@@ -0,0 +1,149 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import time
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PHASES = ("recv", "decode", "lookup", "encode", "send")
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket
+# catches everything slower.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Anything else a client sends is counted under "unknown" so a misbehaving
+# client can't grow the metrics without bound.
+COMMANDS = ("install", "batch", "upload", "user", "session", "preflight", "auth", "version", "package",
+            "search", "stats", "blob", "feed", "quit")
+
+
+class Command:
+    __slots__ = ("count", "phases", "buckets", "total")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.commands = {name: Command() for name in COMMANDS + ("unknown",)}
+        self.sources = {}
+
+        self.received = 0
+        self.sent = 0
+        self.connections = 0
+        self.accepted = 0
+
+    def register(self, name, stats, counters=()):
+        # Stats that only ever go up, named in counters, are exported as
+        # Prometheus counters and everything else as a gauge.
+        self.sources[name] = (stats, frozenset(counters))
+
+    def connect(self):
+        with self.lock:
+            self.connections += 1
+            self.accepted += 1
+
+    def disconnect(self):
+        with self.lock:
+            self.connections -= 1
+
+    def observe(self, command, phases, received, sent):
+        total = sum(phases.values())
+        with self.lock:
+            entry = self.commands.get(command) or self.commands["unknown"]
+            entry.count += 1
+            entry.total += total
+            entry.buckets[bisect_left(BUCKETS, total)] += 1
+            for phase, seconds in phases.items():
+                entry.phases[phase] += seconds
+            self.received += received
+            self.sent += sent
+
+    def snapshot(self):
+        with self.lock:
+            commands = {name: {"count": entry.count, "seconds": entry.total, "phases": dict(entry.phases)}
+                        for name, entry in self.commands.items() if entry.count}
+            stats = {"uptime": time.time() - self.started, "connections": self.connections, "accepted": self.accepted,
+                     "bytes_received": self.received, "bytes_sent": self.sent, "commands": commands}
+        for name, (source, _) in self.sources.items():
+            stats[name] = source()
+        return stats
+
+    def prometheus(self):
+        with self.lock:
+            lines = [
+                "# TYPE cip_uptime_seconds gauge", f"cip_uptime_seconds {time.time() - self.started:.3f}",
+                "# TYPE cip_connections gauge", f"cip_connections {self.connections}",
+                "# TYPE cip_connections_accepted_total counter", f"cip_connections_accepted_total {self.accepted}",
+                "# TYPE cip_bytes_received_total counter", f"cip_bytes_received_total {self.received}",
+                "# TYPE cip_bytes_sent_total counter", f"cip_bytes_sent_total {self.sent}",
+                "# TYPE cip_command_seconds histogram",
+            ]
+            for name, entry in self.commands.items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), entry.buckets):
+                    cumulative += count
+                    lines.append(f'cip_command_seconds_bucket{{command="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'cip_command_seconds_sum{{command="{name}"}} {entry.total:.6f}')
+                lines.append(f'cip_command_seconds_count{{command="{name}"}} {entry.count}')
+
+            lines.append("# TYPE cip_command_phase_seconds_total counter")
+            for name, entry in self.commands.items():
+                for phase, seconds in entry.phases.items():
+                    lines.append(f'cip_command_phase_seconds_total{{command="{name}",phase="{phase}"}} {seconds:.6f}')
+
+        for source, (fetch, counters) in self.sources.items():
+            for key, value in fetch().items():
+                if key in counters:
+                    lines.append(f"# TYPE cip_{source}_{key}_total counter")
+                    lines.append(f"cip_{source}_{key}_total {value}")
+                else:
+                    lines.append(f"# TYPE cip_{source}_{key} gauge")
+                    lines.append(f"cip_{source}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
@@ -0,0 +1,208 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import time
+import queue
+import socket
+import threading
+
+from registry import Registry
+from protocol import ProtocolError, Connection, keepalive
+
+RETRY = 1
+FETCH_TIMEOUT = 300
+# Three missed heartbeats and the primary is taken to be gone.
+FEED_TIMEOUT = 45
+
+
+class Mirror:
+    # Keeps a read-only copy of another server. Every change the primary
+    # makes is applied here under the same sequence number and written to
+    # this server's own journal, so after a restart the mirror only asks for
+    # what came after the last change it has. Blobs are pulled separately,
+    # in the background as they're published, or right away when a client
+    # wants one that hasn't arrived yet.
+    def __init__(self, server, primary, token):
+        self.server = server
+        self.primary = primary
+        self.token = token
+        self.lock = threading.Lock()
+        self.fetching = {}
+        self.wanted = queue.Queue()
+
+    def start(self):
+        threading.Thread(target=self.follow, daemon=True).start()
+        threading.Thread(target=self.fetcher, daemon=True).start()
+
+    def redirect(self, reason):
+        return {"type": "reply", "reply": reason, "primary": list(self.primary)}
+
+    def connect(self, timeout=None):
+        conn = socket.create_connection(self.primary, timeout)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        keepalive(conn)
+        connection = Connection(conn)
+        connection.greet()
+        return connection
+
+    def follow(self):
+        while True:
+            try:
+                self.subscribe()
+            except (OSError, ProtocolError, KeyError, ValueError) as e:
+                print(f"[MIRROR] Lost {self.primary[0]}:{self.primary[1]}: {e}")
+            time.sleep(RETRY)
+
+    def subscribe(self):
+        conn = self.connect(FEED_TIMEOUT)
+        try:
+            while True:
+                since = self.server.journal.seq
+                conn.send({"type": "feed", "since": since, "token": self.token})
+                if (reply := conn.recv())["reply"] != "success":
+                    raise ProtocolError(f"Feed refused: {reply['reply']}")
+                print(f"[MIRROR] Following {self.primary[0]}:{self.primary[1]} from change {since}, "
+                      f"primary is at {reply['seq']}")
+                self.receive(conn)
+        finally:
+            conn.conn.close()
+
+    def receive(self, conn):
+        restoring = None
+        while True:
+            message = conn.recv()
+            kind = message["type"]
+            if kind == "changes":
+                for seq, op, args in message["changes"]:
+                    self.apply(seq, op, args)
+            elif kind == "snapshot":
+                registry = Registry()
+                registry.defer()
+                registry.index.defer()
+                for user in message["users"]:
+                    registry.add_user(*user)
+                restoring = (message["seq"], registry)
+            elif kind == "versions":
+                for version in message["versions"]:
+                    restoring[1].add_package(*normalize(version))
+            elif kind == "restored":
+                self.adopt(*restoring)
+                restoring = None
+            elif kind == "resubscribe":
+                return
+
+    def apply(self, seq, op, args):
+        server = self.server
+        if op == "add_package":
+            args = normalize(args)
+        with server.lock:
+            if seq != server.journal.seq + 1:
+                raise ProtocolError(f"Expected change {server.journal.seq + 1}, got {seq}")
+            result, _ = server.apply(op, *args)
+
+        if op == "add_package":
+            self.wanted.put((args[3], args[1], args[2]))
+        elif op == "delete_user":
+            server.journal.wait(seq)
+            server.collect(result)
+
+    def adopt(self, seq, registry):
+        # Too far behind to catch up change by change, so the registry the
+        # primary sent replaces this one outright.
+        server = self.server
+        registry.settle()
+        registry.index.resume()
+        with server.lock:
+            orphans = set(server.registry.blobs) - set(registry.blobs)
+            server.registry = registry
+            server.journal.restart(seq)
+        server.snapshot()
+        server.collect(orphans)
+        self.want_missing()
+        print(f"[MIRROR] Restored the registry at change {seq}")
+
+    def want_missing(self):
+        for pack in list(self.server.registry.packages.values()):
+            for ver in list(pack.versions.values()):
+                if ver.digest not in self.server.store:
+                    self.wanted.put((ver.digest, pack.name, ver.version))
+
+    def fetcher(self):
+        self.want_missing()
+        while True:
+            digest, package, version = self.wanted.get()
+            if digest in self.server.registry.blobs and self.ensure(digest):
+                self.server.deltas.put((package, version))
+
+    def ensure(self, digest):
+        # Whoever asks for a blob first pulls it, anyone else asking in the
+        # meantime waits for that rather than pulling it again.
+        if digest in self.server.store:
+            return True
+        with self.lock:
+            if (done := self.fetching.get(digest)) is None:
+                done = self.fetching[digest] = threading.Event()
+                pulling = True
+            else:
+                pulling = False
+
+        if not pulling:
+            done.wait(FETCH_TIMEOUT)
+            return digest in self.server.store
+        try:
+            self.pull(digest)
+        except (OSError, ProtocolError) as e:
+            print(f"[MIRROR] Could not pull {digest}: {e}")
+        finally:
+            with self.lock:
+                del self.fetching[digest]
+            done.set()
+        return digest in self.server.store
+
+    def pull(self, digest):
+        server = self.server
+        upload = server.store.begin(f"mirror/{digest}")
+        try:
+            conn = self.connect(FETCH_TIMEOUT)
+            try:
+                conn.send({"type": "blob", "digest": digest, "offset": upload.size})
+                if (reply := conn.recv())["reply"] != "success":
+                    raise ProtocolError(reply["reply"])
+                conn.recv_stream(upload, reply["offset"])
+                conn.send({"type": "quit"})
+            finally:
+                conn.conn.close()
+        finally:
+            upload.close()
+
+        if upload.digest() != digest:
+            server.store.discard(upload)
+            raise ProtocolError("Blob arrived corrupted")
+        with server.lock:
+            if digest in server.registry.blobs:
+                server.store.place(str(upload.path), digest)
+            else:
+                server.store.discard(upload)
+
+
+def normalize(args):
+    # Dependencies were tuples on the primary and come back as lists.
+    args = list(args)
+    args[6] = tuple(map(tuple, args[6]))
+    return args
@@ -0,0 +1,503 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+import json
+import zlib
+import socket
+import asyncio
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Every frame starts with a fixed header: one byte for the frame kind and
+# an unsigned 64 bit payload length, both in network byte order.
+HEADER = struct.Struct("!BQ")
+
+# Streams are sent as a series of CHUNK or RAW frames terminated by an END
+# frame. Each of them starts with the uncompressed offset of its data so a
+# transfer that got cut off can be picked up again from wherever it stopped.
+# CHUNK frames are zlib compressed, RAW frames are copied straight from a file
+# with sendfile and are written to disk as they arrive.
+OFFSET = struct.Struct("!Q")
+
+MESSAGE = 0
+CHUNK = 2
+END = 3
+RAW = 4
+HELLO = 5
+
+# A message payload starts with one byte, the codec its body was encoded
+# with in the high four bits and how it was compressed in the low four, so
+# any message can be decoded whatever the two sides agreed on. Both ends
+# start out with JSON and no compression, which every peer understands, and
+# switch once a HELLO frame told them what the other side can read.
+CODECS = {
+    "json": (0, lambda obj: json.dumps(obj, separators=(",", ":")).encode(), json.loads),
+}
+if msgpack is not None:
+    CODECS["msgpack"] = (1, msgpack.packb, msgpack.unpackb)
+
+# Messages, and compressed stream chunks, are read into memory whole before
+# they're looked at. Nothing a peer sends legitimately comes close to this,
+# the length in a header claiming more is a broken or hostile peer. It's
+# also as much as one of them may decompress to, a few kilobytes of zeroes
+# can otherwise turn into gigabytes.
+MAX_FRAME = 64 << 20
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def inflate(decomp, data):
+    data = decomp.decompress(data, MAX_FRAME)
+    if decomp.unconsumed_tail:
+        raise ProtocolError(f"Frame decompresses to more than {MAX_FRAME} bytes")
+    return data
+
+
+def unzlib(data):
+    decomp = zlib.decompressobj()
+    data = inflate(decomp, data)
+    if not decomp.eof:
+        raise ProtocolError("Truncated message")
+    return data
+
+
+def unlz4(data):
+    decomp = lz4.frame.LZ4FrameDecompressor()
+    data = decomp.decompress(data, max_length=MAX_FRAME)
+    if not decomp.needs_input:
+        raise ProtocolError(f"Frame decompresses to more than {MAX_FRAME} bytes")
+    if not decomp.eof:
+        raise ProtocolError("Truncated message")
+    return data
+
+
+def unzstd(data):
+    # The size in a zstd frame's header is whatever the peer wrote there, a
+    # one shot decompress would allocate it up front.
+    body = bytearray()
+    for chunk in zstandard.ZstdDecompressor().read_to_iter(data):
+        body += chunk
+        if len(body) > MAX_FRAME:
+            raise ProtocolError(f"Frame decompresses to more than {MAX_FRAME} bytes")
+    return body
+
+
+COMPRESSORS = {
+    "none": (0, None, None),
+    "zlib": (1, zlib.compress, unzlib),
+}
+# The levels each compressor takes. The configured one is meant for the
+# preferred compressor, anything else in use, a peer that can't read it or
+# the zlib streams always use, gets the nearest level it does take.
+LEVELS = {"zlib": (-1, 9)}
+# What each decompressor raises for data it can't make sense of.
+ERRORS = (ValueError, zlib.error)
+if lz4 is not None:
+    COMPRESSORS["lz4"] = (2, lambda data, level: lz4.frame.compress(data, compression_level=level), unlz4)
+    LEVELS["lz4"] = (0, lz4.frame.COMPRESSIONLEVEL_MAX)
+    ERRORS += (RuntimeError,)
+if zstandard is not None:
+    COMPRESSORS["zstd"] = (3, lambda data, level: zstandard.ZstdCompressor(level).compress(data), unzstd)
+    LEVELS["zstd"] = (1, zstandard.MAX_COMPRESSION_LEVEL)
+    ERRORS += (zstandard.ZstdError,)
+
+DECODERS = {number: loads for number, _, loads in CODECS.values()}
+DECOMPRESSORS = {number: decompress for number, _, decompress in COMPRESSORS.values()}
+
+# Most messages are a few dozen bytes, too few for compression to win back
+# the time it takes. A body or stream chunk that shrinks by less than a
+# tenth is sent as it is.
+SMALL = 1 << 10
+RATIO = 0.9
+# After this many stream chunks in a row that didn't compress the rest of the
+# stream isn't tried either, it's most likely an archive or a binary.
+GIVE_UP = 4
+
+# A peer that vanished without closing its connection, a crashed host or a
+# pulled cable, is given up on after KEEPALIVE_IDLE seconds of silence and
+# KEEPALIVE_COUNT unanswered probes KEEPALIVE_INTERVAL seconds apart.
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 6
+
+# The preferred codec and compression, set from the config.
+settings = {"codec": "msgpack" if msgpack is not None else "json", "compression": "zlib", "level": 1}
+
+
+def keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Only Linux lets the timings be set per socket.
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+
+
+def configure(compression=None, level=None):
+    if compression is not None:
+        if compression not in COMPRESSORS:
+            raise ValueError(f"Unsupported compression {compression}, choose from {', '.join(COMPRESSORS)}")
+        settings["compression"] = compression
+    if level is not None:
+        if (limits := LEVELS.get(settings["compression"])) is not None and not limits[0] <= int(level) <= limits[1]:
+            raise ValueError(f"Compression level {level} is not between {limits[0]} and {limits[1]} "
+                             f"for {settings['compression']}")
+        settings["level"] = int(level)
+
+
+def level_for(compression):
+    if (limits := LEVELS.get(compression)) is None:
+        return settings["level"]
+    return min(max(settings["level"], limits[0]), limits[1])
+
+
+def offer():
+    # The preferred choice first, then everything else this side can read.
+    codecs = [settings["codec"]] + [name for name in CODECS if name != settings["codec"]]
+    compressors = [settings["compression"]] + [name for name in COMPRESSORS if name != settings["compression"]]
+    return json.dumps({"codecs": codecs, "compression": compressors}).encode()
+
+
+def encode(obj, codec="json", compression="none", level=1):
+    number, dumps, _ = CODECS[codec]
+    body = dumps(obj)
+    method, compress, _ = COMPRESSORS[compression]
+    if compress is not None and len(body) >= SMALL:
+        packed = compress(body, level)
+        if len(packed) < len(body) * RATIO:
+            return bytes([number << 4 | method]) + packed
+    return bytes([number << 4]) + body
+
+
+def decode(data):
+    if not data:
+        raise ProtocolError("Empty message")
+    codec, method = data[0] >> 4, data[0] & 0xF
+    if codec not in DECODERS or method not in DECOMPRESSORS:
+        raise ProtocolError(f"Unsupported message encoding {data[0]}")
+    body = memoryview(data)[1:]
+    try:
+        if (decompress := DECOMPRESSORS[method]) is not None:
+            body = decompress(body)
+        return DECODERS[codec](bytes(body))
+    except ERRORS as e:
+        raise ProtocolError(f"Malformed message: {e}") from None
+
+
+def stream_frames(f, offset=0, chunk_size=1 << 18):
+    comp = zlib.compressobj(level_for("zlib"))
+    view = memoryview(bytearray(chunk_size))
+    misses = 0
+    f.seek(offset)
+
+    while n := f.readinto(view):
+        chunk = view[:n]
+        if misses < GIVE_UP:
+            # The compressor keeps what it saw for later back references,
+            # a chunk that goes out raw must not be in there.
+            before = comp.copy()
+            data = comp.compress(chunk) + comp.flush(zlib.Z_SYNC_FLUSH)
+            if len(data) < n * RATIO:
+                misses = 0
+                yield HEADER.pack(CHUNK, OFFSET.size + len(data)) + OFFSET.pack(offset) + data
+                offset += n
+                continue
+            comp = before
+            misses += 1
+        yield HEADER.pack(RAW, OFFSET.size + n) + OFFSET.pack(offset) + bytes(chunk)
+        offset += n
+
+    yield HEADER.pack(END, OFFSET.size) + OFFSET.pack(offset)
+
+
+def encode_stream(f):
+    return b"".join(stream_frames(f))
+
+
+class Negotiated:
+    # What this side sends with, until the peer's HELLO says it can read more.
+    codec = "json"
+    compression = "none"
+
+    def hello(self, data):
+        try:
+            peer = json.loads(bytes(data))
+        except ValueError:
+            raise ProtocolError("Malformed HELLO") from None
+        codecs = [settings["codec"]] + list(CODECS)
+        self.codec = next((name for name in codecs if name in peer.get("codecs", ())), "json")
+        compressors = [settings["compression"]] + list(COMPRESSORS)
+        self.compression = next((name for name in compressors if name in peer.get("compression", ())), "none")
+
+    def encode(self, obj):
+        return encode(obj, self.codec, self.compression, level_for(self.compression))
+
+
+def check_start(kind, start, offset):
+    if kind not in (CHUNK, RAW, END) or OFFSET.unpack(start)[0] != offset:
+        raise ProtocolError("Stream frame out of order")
+
+
+class Connection(Negotiated):
+    small_frame = 8192
+    chunk_size = 1 << 18
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.header = bytearray(HEADER.size)
+        # Only made once a stream arrives, most connections never get one.
+        self.buffer = None
+        self.received = 0
+        self.sent = 0
+
+    def recv_into(self, view):
+        self.received += len(view)
+        while view:
+            n = self.conn.recv_into(view)
+            if not n:
+                raise ConnectionError("Connection closed by peer")
+            view = view[n:]
+
+    def send_frame(self, kind, data, prefix=b""):
+        header = HEADER.pack(kind, len(prefix) + len(data)) + prefix
+        self.sent += len(header) + len(data)
+        if len(data) <= self.small_frame:
+            self.conn.sendall(header + data)
+        else:
+            self.conn.sendall(header)
+            self.conn.sendall(data)
+
+    def read_header(self):
+        self.recv_into(memoryview(self.header))
+        return HEADER.unpack(self.header)
+
+    def read_payload(self, length, reuse=False):
+        if length > MAX_FRAME:
+            raise ProtocolError(f"Frame of {length} bytes is too large")
+        if reuse:
+            data = memoryview(self.scratch(length))[:length]
+        else:
+            data = bytearray(length)
+        self.recv_into(memoryview(data))
+        return data
+
+    def scratch(self, size=0):
+        if self.buffer is None or size > len(self.buffer):
+            self.buffer = bytearray(max(size, self.chunk_size + self.small_frame))
+        return self.buffer
+
+    def read_frame(self, reuse=False):
+        kind, length = self.read_header()
+        return kind, self.read_payload(length, reuse)
+
+    def recv_frame(self, kind):
+        got, data = self.read_frame()
+        while got == HELLO:
+            self.hello(data)
+            got, data = self.read_frame()
+        if got != kind:
+            raise ProtocolError(f"Expected frame kind {kind}, got {got}")
+        return data
+
+    def greet(self):
+        # The reply comes back ahead of whatever is asked next, so nothing
+        # waits for it.
+        self.send_frame(HELLO, offer())
+
+    def send(self, obj):
+        self.send_frame(MESSAGE, self.encode(obj))
+
+    def recv(self):
+        return decode(self.recv_frame(MESSAGE))
+
+    def send_stream(self, f, offset=0):
+        for frame in stream_frames(f, offset, self.chunk_size):
+            self.sent += len(frame)
+            self.conn.sendall(frame)
+
+    def send_raw(self, data):
+        self.sent += len(data)
+        self.conn.sendall(data)
+
+    def send_pieces(self, pieces, offset=0):
+        pending = bytearray()
+        for piece in pieces:
+            pending += piece
+            if len(pending) >= self.chunk_size:
+                self.send_frame(RAW, pending, OFFSET.pack(offset))
+                offset += len(pending)
+                pending = bytearray()
+
+        if pending:
+            self.send_frame(RAW, pending, OFFSET.pack(offset))
+            offset += len(pending)
+        self.send_frame(END, b"", OFFSET.pack(offset))
+        return offset
+
+    def send_file(self, f, offset=0):
+        count = os.fstat(f.fileno()).st_size - offset
+        self.conn.sendall(HEADER.pack(RAW, OFFSET.size + count) + OFFSET.pack(offset))
+        self.sent += HEADER.size + OFFSET.size + count
+        if count:
+            self.conn.sendfile(f, offset, count)
+
+        offset += count
+        self.send_frame(END, b"", OFFSET.pack(offset))
+        return offset
+
+    def recv_stream(self, f, offset=0):
+        decomp = zlib.decompressobj()
+        f.seek(offset)
+        f.truncate()
+
+        while True:
+            kind, length = self.read_header()
+            check_start(kind, self.read_payload(OFFSET.size, reuse=True), offset)
+            length -= OFFSET.size
+
+            if kind == END:
+                return offset
+
+            elif kind == RAW:
+                view = memoryview(self.scratch())
+                while length:
+                    n = self.conn.recv_into(view, min(length, len(view)))
+                    if not n:
+                        raise ConnectionError("Connection closed by peer")
+                    self.received += n
+                    f.write(view[:n])
+                    length -= n
+                    offset += n
+
+            else:
+                try:
+                    chunk = inflate(decomp, self.read_payload(length, reuse=True))
+                except zlib.error as e:
+                    raise ProtocolError(f"Malformed stream: {e}") from None
+                f.write(chunk)
+                offset += len(chunk)
+
+
+class AsyncConnection(Negotiated):
+    chunk_size = Connection.chunk_size
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.received = 0
+        self.sent = 0
+
+    async def read_exactly(self, n):
+        if n > MAX_FRAME:
+            raise ProtocolError(f"Frame of {n} bytes is too large")
+        self.received += n
+        try:
+            return await self.reader.readexactly(n)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed by peer") from None
+
+    async def read_header(self):
+        return HEADER.unpack(await self.read_exactly(HEADER.size))
+
+    async def read_payload(self, length):
+        return await self.read_exactly(length)
+
+    async def read_frame(self):
+        kind, length = await self.read_header()
+        return kind, await self.read_payload(length)
+
+    async def send_frame(self, kind, data, prefix=b""):
+        self.writer.write(HEADER.pack(kind, len(prefix) + len(data)) + prefix)
+        self.sent += HEADER.size + len(prefix) + len(data)
+        if data:
+            self.writer.write(data)
+        await self.writer.drain()
+
+    async def send(self, obj):
+        await self.send_frame(MESSAGE, self.encode(obj))
+
+    async def recv(self):
+        kind, data = await self.read_frame()
+        while kind == HELLO:
+            self.hello(data)
+            kind, data = await self.read_frame()
+        if kind != MESSAGE:
+            raise ProtocolError(f"Expected frame kind {MESSAGE}, got {kind}")
+        return decode(data)
+
+    async def send_raw(self, data):
+        self.sent += len(data)
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def send_file(self, f, offset=0):
+        count = os.fstat(f.fileno()).st_size - offset
+        self.writer.write(HEADER.pack(RAW, OFFSET.size + count) + OFFSET.pack(offset))
+        self.sent += HEADER.size + OFFSET.size + count
+        if count:
+            await asyncio.get_running_loop().sendfile(self.writer.transport, f, offset, count)
+
+        offset += count
+        await self.send_frame(END, b"", OFFSET.pack(offset))
+        return offset
+
+    async def recv_stream(self, f, offset=0):
+        decomp = zlib.decompressobj()
+        f.seek(offset)
+        f.truncate()
+
+        while True:
+            kind, length = await self.read_header()
+            check_start(kind, await self.read_exactly(OFFSET.size), offset)
+            length -= OFFSET.size
+
+            if kind == END:
+                return offset
+
+            elif kind == RAW:
+                while length:
+                    data = await self.read_exactly(min(length, self.chunk_size))
+                    f.write(data)
+                    length -= len(data)
+                    offset += len(data)
+
+            else:
+                try:
+                    chunk = inflate(decomp, await self.read_exactly(length))
+                except zlib.error as e:
+                    raise ProtocolError(f"Malformed stream: {e}") from None
+                f.write(chunk)
+                offset += len(chunk)
@@ -0,0 +1,406 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import re
+from time import time as time_now
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+from search import SearchIndex
+
+RANGE = re.compile(r"\s*(\^|~|>=|<=|==|=|>|<)?\s*([0-9A-Za-z.+-]+)\s*")
+# Package names and versions end up in paths on the client, so neither can
+# be anything that would step out of a directory.
+NAME = re.compile(r"[A-Za-z0-9-]+")
+VERSION = re.compile(r"[0-9A-Za-z][0-9A-Za-z.+-]*")
+DIGEST = re.compile(r"[0-9a-f]{64}")
+
+
+def version_parts(string):
+    return tuple((0, int(p)) if p.isdigit() else (1, p) for p in string.split(".") if p)
+
+
+@lru_cache(maxsize=1 << 16)
+def version_key(version):
+    release, _, pre = version.partition("-")
+    parts = version_parts(release)
+    while parts and parts[-1] == (0, 0):
+        parts = parts[:-1]
+    # A pre-release sorts right before the release it leads up to.
+    return parts, (0, version_parts(pre)) if pre else (1,)
+
+
+def bump(version, op):
+    parts = [int(p) for p in re.match(r"[0-9.]*", version).group().split(".") if p] or [0]
+    if op == "^":
+        index = next((i for i, p in enumerate(parts) if p), len(parts) - 1)
+    else:
+        index = min(1, len(parts) - 1)
+    parts = parts[:index+1]
+    parts[-1] += 1
+    # Lower than every pre-release of the bumped version too.
+    return version_parts(".".join(map(str, parts))), (0, ())
+
+
+def parse_range(spec):
+    lower, lower_inclusive = None, True
+    upper, upper_inclusive = None, True
+
+    for clause in spec.split(","):
+        if (match := RANGE.fullmatch(clause)) is None:
+            raise ValueError(f"Invalid version range {spec}")
+        op, version = match.groups()
+        key = version_key(version)
+
+        bounds = []
+        if op in ("^", "~"):
+            bounds = [(">=", key), ("<", bump(version, op))]
+        elif op in (None, "==", "="):
+            bounds = [(">=", key), ("<=", key)]
+        elif op == "<" and "-" not in version:
+            # <2 shouldn't let 2.0-alpha through.
+            bounds = [(op, (key[0], (0, ())))]
+        else:
+            bounds = [(op, key)]
+
+        for op, key in bounds:
+            if op[0] == ">":
+                if lower is None or key > lower or (key == lower and op == ">"):
+                    lower, lower_inclusive = key, op == ">="
+            elif upper is None or key < upper or (key == upper and op == "<"):
+                upper, upper_inclusive = key, op == "<="
+
+    # Pre-releases are only considered by a range that names one.
+    return lower, lower_inclusive, upper, upper_inclusive, "-" in spec
+
+
+def dependency_error(dependencies):
+    for dependency in dependencies:
+        if not isinstance(dependency, (list, tuple)) or len(dependency) != 2:
+            return f"Invalid dependency {dependency}"
+        package, version = dependency
+        if not isinstance(package, str) or NAME.fullmatch(package) is None:
+            return f"Invalid dependency {package}"
+        if not isinstance(version, str):
+            return f"Invalid version {version} for dependency {package}"
+        if version != "RECENT":
+            try:
+                parse_range(version)
+            except ValueError as e:
+                return f"{e} for dependency {package}"
+
+
+def placed(pair, old, ver):
+    # A copy of a sorted (keys, versions) pair with old taken out and ver
+    # put in its place.
+    keys, ordered = list(pair[0]), list(pair[1])
+    if old is not None:
+        for index in range(bisect_left(keys, old.key), bisect_right(keys, old.key)):
+            if ordered[index] is old:
+                del keys[index], ordered[index]
+                break
+    index = bisect_right(keys, ver.key)
+    keys.insert(index, ver.key)
+    ordered.insert(index, ver)
+    return keys, ordered
+
+
+class Version:
+    __slots__ = ("time", "owner", "version", "key", "digest", "size", "dependencies")
+
+    def __init__(self, owner, version, digest, size, time=None, dependencies=()):
+        self.time = time or time_now()
+        self.owner = owner
+        self.version = version
+        self.key = version_key(version)
+        self.digest = digest
+        self.size = size
+        self.dependencies = tuple(dependencies)
+
+    @property
+    def prerelease(self):
+        return self.key[1] != (1,)
+
+    def __eq__(self, version):
+        return self.version == version
+
+    def __ne__(self, version):
+        return self.version != version
+
+    def __hash__(self):
+        return hash(self.version)
+
+
+class Package:
+    def __init__(self, name, owner, description=""):
+        self.name = name
+        self.owner = owner
+        self.description = description
+        self.versions = {}
+        # The sorted keys and the versions they belong to are only ever
+        # replaced together as a new pair, never changed in place, so readers
+        # can use them without taking the registry lock. Releases, leaving
+        # out the pre-releases, are kept sorted the same way on their own.
+        self.sorted = ((), ())
+        self.releases = ((), ())
+
+    @property
+    def latest(self):
+        # A pre-release only when there's nothing else to pick.
+        ordered = self.releases[1] or self.sorted[1]
+        return ordered[-1] if ordered else None
+
+    @property
+    def newest(self):
+        ordered = self.sorted[1]
+        return ordered[-1] if ordered else None
+
+    def add_version(self, version, digest, size, time=None, dependencies=()):
+        ver = Version(self, version, digest, size, time, dependencies)
+        old = self.versions.get(version)
+        self.sorted = placed(self.sorted, old, ver)
+        if not ver.prerelease:
+            self.releases = placed(self.releases, old, ver)
+        self.versions[version] = ver
+        return ver
+
+    def load_version(self, version, digest, size, time=None, dependencies=()):
+        # Left unsorted until settle(), for a registry nobody reads yet.
+        # Taken out first so a replaced version sorts after equal keys, the
+        # way add_version would have put it.
+        self.versions.pop(version, None)
+        self.versions[version] = Version(self, version, digest, size, time, dependencies)
+
+    def settle(self):
+        ordered = sorted(self.versions.values(), key=lambda ver: ver.key)
+        releases = [ver for ver in ordered if not ver.prerelease]
+        self.sorted = ([ver.key for ver in ordered], ordered)
+        self.releases = ([ver.key for ver in releases], releases)
+
+    def get_version(self, version):
+        if version == "RECENT":
+            return self.latest
+        if (ver := self.versions.get(version)) is not None:
+            return ver
+        return self.match(*parse_range(version))
+
+    def match(self, lower, lower_inclusive, upper, upper_inclusive, prerelease=False):
+        keys, ordered = self.sorted if prerelease else self.releases
+        if upper is None:
+            index = len(keys)
+        elif upper_inclusive:
+            index = bisect_right(keys, upper)
+        else:
+            index = bisect_left(keys, upper)
+
+        if not index:
+            return None
+        key = keys[index-1]
+        if lower is not None and (key < lower or (key == lower and not lower_inclusive)):
+            return None
+        return ordered[index-1]
+
+    def satisfies(self, ver, version):
+        if version == "RECENT":
+            return ver is self.latest
+        if version == ver.version:
+            return True
+
+        lower, lower_inclusive, upper, upper_inclusive, prerelease = parse_range(version)
+        if ver.prerelease and not prerelease:
+            return False
+        if lower is not None and (ver.key < lower or (ver.key == lower and not lower_inclusive)):
+            return False
+        if upper is not None and (ver.key > upper or (ver.key == upper and not upper_inclusive)):
+            return False
+        return True
+
+    def __eq__(self, pack):
+        return self.name == pack
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __str__(self):
+        if self.description:
+            return f"{self.name} ({len(self.versions)} versions): {self.description}"
+        return f"{self.name} ({len(self.versions)} versions)"
+
+
+class User:
+    def __init__(self, username, password, email, website, github, description):
+        self.username = username
+        self.password = password
+        self.email = email
+        self.website = website
+        self.github = github
+        self.description = description
+        self.packages = {}
+
+    def auth(self, pwd):
+        return pwd == self.password
+
+    def __eq__(self, name):
+        return self.username == name
+
+    def __ne__(self, name):
+        return self.username != name
+
+    def __hash__(self):
+        return hash(self.username)
+
+    def __str__(self):
+        lines = [
+            f"User: {self.username}",
+            f"Email: {self.email}",
+            f"Website: {self.website}",
+            f"Github: {self.github}",
+            f"Description: {self.description}",
+        ]
+        if packages := self.packages:
+            lines.append("Packages:")
+            lines.extend(str(pack) for pack in packages.values())
+        else:
+            lines.append("This user hasn't created any packages yet")
+        return "\n".join(lines)
+
+
+class Registry:
+    def __init__(self):
+        self.users = {}
+        self.packages = {}
+        self.blobs = {}
+        self.index = SearchIndex()
+        self.loading = False
+
+    def defer(self):
+        # Copy-on-write makes every insert cost as much as the containers it
+        # copies, so a whole registry read back from a snapshot and the
+        # journal, or sent to a mirror, is filled in place instead and each
+        # package sorted once at the end. Nothing reads it until settle().
+        self.loading = True
+
+    def settle(self):
+        for pack in self.packages.values():
+            pack.settle()
+        self.loading = False
+
+    def dump(self):
+        users = [(u.username, u.password, u.email, u.website, u.github, u.description) for u in self.users.values()]
+        versions = [(p.owner, p.name, v.version, v.digest, v.size, v.time, v.dependencies, p.description) for p in self.packages.values() for v in p.versions.values()]
+        return users, versions
+
+    def restore(self, state):
+        users, versions = state
+        for user in users:
+            self.add_user(*user)
+        for version in versions:
+            self.add_package(*version)
+
+    def get_user(self, username):
+        if (user := self.users.get(username)) is not None:
+            return user
+        return f"No user named {username}"
+
+    def check_user(self, username):
+        return username not in self.users
+
+    def add_user(self, username, password, email, website, github, description):
+        self.users[username] = User(username, password, email, website, github, description)
+
+    def delete_user(self, username):
+        orphans = []
+        user = self.users.pop(username)
+        for name, pack in user.packages.items():
+            del self.packages[name]
+            self.index.remove(name)
+            for ver in pack.versions.values():
+                self.blobs[ver.digest] -= 1
+                if not self.blobs[ver.digest]:
+                    del self.blobs[ver.digest]
+                    orphans.append(ver.digest)
+        return orphans
+
+    def auth(self, username, password):
+        user = self.users.get(username)
+        return user is not None and user.auth(password)
+
+    def package_exists(self, username, package):
+        pack = self.packages.get(package)
+        return pack is not None and pack.owner != username
+
+    def add_package(self, username, package, version, digest, size, time=None, dependencies=(), description=None):
+        pack = self.packages.get(package)
+        if pack is None:
+            pack = Package(package, username, description or "")
+            self.packages[package] = pack
+            # Swapped rather than updated so listing a user never sees the
+            # dict change size under it.
+            user = self.users[username]
+            if self.loading:
+                user.packages[package] = pack
+            else:
+                user.packages = {**user.packages, package: pack}
+            self.index.add(package, username, pack.description)
+        elif description and description != pack.description:
+            pack.description = description
+            self.index.add(package, username, description)
+
+        if self.loading:
+            pack.load_version(version, digest, size, time, dependencies)
+        else:
+            pack.add_version(version, digest, size, time, dependencies)
+        self.blobs[digest] = self.blobs.get(digest, 0) + 1
+
+    def get_version(self, package, version):
+        pack = self.packages.get(package)
+        if pack is None:
+            return f"Package {package} does not exist"
+
+        try:
+            ver = pack.get_version(version)
+        except ValueError as e:
+            return str(e)
+
+        if ver is None:
+            return f"Package {package} has no version {version}"
+        return ver
+
+    def resolve(self, specs):
+        resolved = {}
+        queue = deque(specs)
+        while queue:
+            package, version = queue.popleft()
+            if (other := resolved.get(package)) is not None:
+                try:
+                    if other.owner.satisfies(other, version):
+                        continue
+                except ValueError as e:
+                    return str(e)
+                return f"Conflicting versions for {package}: {other.version} does not match {version}"
+
+            ver = self.get_version(package, version)
+            if isinstance(ver, str):
+                return ver
+
+            resolved[package] = ver
+            queue.extend(ver.dependencies)
+
+        return list(resolved.values())
@@ -0,0 +1,225 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import re
+import heapq
+import threading
+from collections import deque
+
+TOKEN = re.compile(r"[a-z0-9]+")
+
+# A hit on the package name counts for more than one on its owner, which in
+# turn beats a word somewhere in the description.
+NAME = 4
+OWNER = 2
+DESCRIPTION = 1
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower()) if text else []
+
+
+def trigrams(token):
+    padded = f"  {token} "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    page_size = 20
+    fuzzy_threshold = 0.3
+    build_batch = 10000
+    # A term shorter than min_prefix only matches tokens equal to it, and a
+    # longer one is expanded to at most max_expansion tokens starting with
+    # it, the shortest first. A letter or two would otherwise walk most of
+    # the trie with the lock held.
+    min_prefix = 2
+    max_expansion = 64
+    common_gram = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.ready.set()
+        self.pending = None
+
+        self.docs = {}
+        self.postings = {}
+        self.trie = {}
+        self.grams = {}
+
+    def defer(self):
+        # Indexing every package takes far longer than loading the registry,
+        # so while the journal is replayed packages are only collected and the
+        # index is built in the background once the server is up.
+        self.pending = {}
+        self.ready.clear()
+
+    def resume(self):
+        threading.Thread(target=self.build, daemon=True).start()
+
+    def build(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.pending = None
+                    self.ready.set()
+                    return
+                for _ in range(min(self.build_batch, len(self.pending))):
+                    name, (owner, description) = self.pending.popitem()
+                    self.index(name, owner, description)
+
+    def add(self, name, owner, description=""):
+        with self.lock:
+            if self.pending is not None:
+                self.pending[name] = (owner, description)
+            else:
+                self.index(name, owner, description)
+
+    def remove(self, name):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.pop(name, None)
+            self.discard(name)
+
+    def index(self, name, owner, description):
+        weights = {}
+        for text, weight in ((name, NAME), (owner, OWNER), (description, DESCRIPTION)):
+            for token in tokenize(text):
+                weights[token] = max(weights.get(token, 0), weight)
+
+        self.discard(name)
+        self.docs[name] = (owner, description, weights)
+        for token, weight in weights.items():
+            if (posting := self.postings.get(token)) is None:
+                posting = self.postings[token] = {}
+                self.insert(token)
+            posting[name] = weight
+
+    def discard(self, name):
+        if (doc := self.docs.pop(name, None)) is None:
+            return
+        for token in doc[2]:
+            posting = self.postings[token]
+            del posting[name]
+            if not posting:
+                del self.postings[token]
+                self.delete(token)
+
+    def insert(self, token):
+        node = self.trie
+        for char in token:
+            node = node.setdefault(char, {})
+        # The empty key marks the end of a token, it can never be a character.
+        node[""] = True
+
+        for gram in trigrams(token):
+            self.grams.setdefault(gram, set()).add(token)
+
+    def delete(self, token):
+        path = [self.trie]
+        for char in token:
+            path.append(path[-1][char])
+        del path[-1][""]
+        for i in range(len(token), 0, -1):
+            if path[i]:
+                break
+            del path[i-1][token[i-1]]
+
+        for gram in trigrams(token):
+            tokens = self.grams[gram]
+            tokens.discard(token)
+            if not tokens:
+                del self.grams[gram]
+
+    def prefixed(self, prefix):
+        if len(prefix) < self.min_prefix:
+            return [prefix] if prefix in self.postings else []
+
+        node = self.trie
+        for char in prefix:
+            if (node := node.get(char)) is None:
+                return []
+
+        # Breadth first, so the tokens closest to what was typed come first.
+        found = []
+        nodes = deque([(node, prefix)])
+        while nodes and len(found) < self.max_expansion:
+            node, token = nodes.popleft()
+            for char, child in node.items():
+                if char:
+                    nodes.append((child, token + char))
+                else:
+                    found.append(token)
+        return found[:self.max_expansion]
+
+    def similar(self, term):
+        # A gram most tokens share, like the one for a leading letter, says
+        # little about which token was meant and costs the most to walk.
+        # Candidates only come from the rarer ones, and are then compared on
+        # all of them.
+        grams = trigrams(term)
+        candidates = set()
+        for gram in grams:
+            if len(tokens := self.grams.get(gram, ())) <= self.common_gram:
+                candidates.update(tokens)
+
+        for token in candidates:
+            other = trigrams(token)
+            count = len(grams & other)
+            similarity = count / (len(grams) + len(other) - count)
+            if similarity >= self.fuzzy_threshold:
+                yield token, similarity
+
+    def match(self, term):
+        matched = {}
+        for token in self.prefixed(term):
+            factor = 2 if token == term else 1
+            for name, weight in self.postings[token].items():
+                if weight * factor > matched.get(name, 0):
+                    matched[name] = weight * factor
+
+        # Only fall back to fuzzy matching when nothing starts with the term,
+        # a typo is far less likely than a partially typed word.
+        if not matched and len(term) >= 3:
+            for token, similarity in self.similar(term):
+                for name, weight in self.postings[token].items():
+                    if weight * similarity > matched.get(name, 0):
+                        matched[name] = weight * similarity
+        return matched
+
+    def search(self, query, page=1, page_size=None):
+        page_size = page_size or self.page_size
+        if not (terms := tokenize(query)):
+            return [], 0
+
+        self.ready.wait()
+        with self.lock:
+            scores = self.match(terms[0])
+            for term in terms[1:]:
+                if not scores:
+                    break
+                matched = self.match(term)
+                scores = {name: score + matched[name] for name, score in scores.items() if name in matched}
+
+            if (exact := query.strip()) in scores:
+                scores[exact] += NAME * 2 * len(terms)
+
+            start = (page - 1) * page_size
+            best = heapq.nsmallest(start + page_size, scores.items(), key=lambda item: (-item[1], item[0]))[start:]
+            return [(name, *self.docs[name][:2]) for name, _ in best], len(scores)
@@ -17,294 +17,1202 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
+import os
+import gc
+import sys
 import time
-import zlib
+import queue
 import socket
-import pickle
 import ctypes
+import pickle
+import asyncio
+import secrets
+import tempfile
+import resource
+import functools
 import threading
-from datetime import datetime
-
-IP = input("IP: ")
-PORT = int(input("Port: "))
-
-
-class Version:
-    def __init__(self, owner, version, content):
-        self.time = datetime.now()
-        self.owner = owner
-        self.version = version
-        self.content = content
-
-    def __eq__(self, version):
-        return self.version == version
-
-    def __ne__(self, version):
-        return self.version != version
-
-    def get_bytes(self):
-        return self.content
-
-
-class Package:
-    def __init__(self, name):
-        self.name = name
-        self.versions = []
-
-    def add_version(self, version, content):
-        self.versions.append(Version(self, version, content))
-
-    def get_version(self, version):
-        if version == "RECENT":
-            return max(self.versions, key=lambda x: x.time)
-        else:
-            for v in self.versions:
-                if v == version:
-                    return v
-
-    def __eq__(self, pack):
-        return self.name == pack
-
-    def __str__(self):
-        return f"{self.name} ({len(self.versions)} versions)"
-
-
-class User:
-    def __init__(self, username, password, email, website, github, description):
-        self.username = username
-        self.password = password
-        self.email = email
-        self.website = website
-        self.github = github
-        self.description = description
-        self.packages = []
-
-    def add_package(self, package, version, content):
-        for pack in self.packages:
-            if pack == package:
-                pack.add_version(version, content)
-                return
-
-        p = Package(package)
-        p.add_version(version, content)
-        self.packages.append(p)
-
-    def get_version(self, package, version):
-        for pack in self.packages:
-            if pack == package:
-                if ver := pack.get_version(version):
-                    return ver
-                else:
-                    return f"Package {package} has no version {version}"
-
-    def auth(self, pwd):
-        return pwd == self.password
-
-    def __eq__(self, name):
-        return self.username == name
-
-    def __ne__(self, name):
-        return self.username != name
-
-    def __str__(self):
-        string  = f"User: {self.username}\n"
-        string += f"Email: {self.email}\n"
-        string += f"Website: {self.website}\n"
-        string += f"Github: {self.github}\n"
-        string += f"Description: {self.description}\n"
-        if self.packages:
-            packs = set(map(str, self.packages))
-            string += "Packages:\n"
-            for pack in packs[:-1]:
-                string += str(pack) + "\n"
-            string += str(self.packages[-1])
-        else:
-            string += "This user hasn't created any packages yet"
-        return string
+import multiprocessing
+from pathlib import Path
+
+import config
+import delta
+from store import BlobStore
+from cluster import Coordinator, Link
+from hotcache import HotCache
+from journal import Journal
+from limits import FairQueue, RateLimiter
+from mirror import Mirror
+from timers import TimerWheel
+from metrics import PHASES, Metrics
+from registry import NAME, VERSION, DIGEST, Version, dependency_error
+import protocol
+from protocol import MESSAGE, HELLO, ProtocolError, Connection, AsyncConnection, decode, encode_stream, \
+    keepalive, offer
+
+DATA = Path.home() / ".cip"
+
+MAX_CONNECTIONS = 50000
+BACKLOG = 4096
+STREAM_LIMIT = 1 << 16
+
+SESSION_TTL = 12 * 60 * 60
+# Connections that haven't made a request in this many seconds are closed.
+IDLE_TIMEOUT = 5 * 60
+
+HOT_CACHE_SIZE = 256 << 20
+HOT_CACHE_ITEM = 16 << 20
+
+# Changes go out to mirrors in batches of at most this many, with a heartbeat
+# whenever there's been nothing to send for a while. A mirror that falls so
+# far behind that its queue fills up is told to subscribe again, and catches
+# up from the journal instead.
+FEED_BATCH = 1000
+FEED_HEARTBEAT = 15
+FEED_QUEUE = 100000
+
+# Uploads, and installs of more than LARGE_TRANSFER bytes, run WORK_SLOTS at
+# a time. Up to WORK_QUEUE more wait their turn for at most WORK_WAIT
+# seconds, anything past that is told the server is busy.
+LARGE_TRANSFER = 1 << 20
+WORK_SLOTS = 8
+WORK_QUEUE = 256
+WORK_WAIT = 10
+
+
+def listener(host, port):
+    # Every worker of a pre-forked server binds its own socket to the same
+    # port and the kernel spreads incoming connections over them.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def coordinated(method):
+    # In a worker the write is made by the coordinator instead, running the
+    # same method on its own registry and replicating the outcome.
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        if self.coordinator is not None:
+            return self.coordinator.call(method.__name__, *args)
+        return method(self, *args)
+    return wrapper
 
 
 class Server:
-    def __init__(self):
+    def __init__(self, host, port, data=DATA):
+        self.host = host
+        self.port = port
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind((IP, PORT))
-
-        self.clients = []
-        self.users = []
+        # Connections the server closed itself linger in TIME_WAIT for a
+        # while, a restart mustn't have to wait for them.
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+
+        self.clients = set()
+        self.clients_lock = threading.Lock()
+        self.max_connections = MAX_CONNECTIONS
+        self.listen_backlog = BACKLOG
+        self.store = BlobStore(Path(data) / "blobs")
+        self.hot = HotCache(HOT_CACHE_SIZE, HOT_CACHE_ITEM)
+        self.sessions = {}
+        self.journal = Journal(Path(data) / "journal")
+        self.registry = self.journal.load()
+        self.metrics = Metrics()
+        self.metrics.register("hot_cache", self.hot.stats, ("hits", "misses", "evictions"))
+        self.metrics.register("registry", self.registry_stats)
+        self.lock = threading.Lock()
+        self.snapshotting = False
         self.active = True
-
+        self.coordinator = None
+        self.replicas = None
+        self.feeds = set()
+        self.mirror = None
+        self.mirror_token = None
+        self.limits = RateLimiter()
+        self.turns = FairQueue(WORK_SLOTS, WORK_QUEUE)
+        # Made by whichever process ends up serving, a forked child wouldn't
+        # get the thread.
+        self.timers = None
+        self.idle_timeout = IDLE_TIMEOUT
+        self.metrics.register("limits", self.limit_stats, ("throttled", "rejected"))
+
+        self.deltas = queue.Queue()
+        threading.Thread(target=self.compact, daemon=True).start()
+
+    def apply(self, op, *args):
+        # Only ever called with self.lock held. Readers don't take the lock,
+        # the registry swaps in new containers instead of changing the ones a
+        # reader might be walking.
+        result = getattr(self.registry, op)(*args)
+        seq = self.journal.append(op, args)
+        if self.replicas is not None:
+            self.replicas.broadcast(("op", seq, op, args))
+        self.announce(seq, op, args)
+        if self.journal.needs_snapshot() and not self.snapshotting:
+            self.snapshotting = True
+            threading.Thread(target=self.snapshot).start()
+        return result, seq
+
+    def announce(self, seq, op, args):
+        lagging = []
+        for changes in self.feeds:
+            try:
+                changes.put_nowait((seq, op, args))
+            except queue.Full:
+                lagging.append(changes)
+        for changes in lagging:
+            changes.lagging = True
+            self.feeds.discard(changes)
+
+    def feed(self, cmd):
+        # A mirror subscribing to every change: first whatever it's missing
+        # after the sequence number it has, then each one as it's made.
+        if not self.mirror_token or not secrets.compare_digest(str(cmd.get("token") or ""), self.mirror_token):
+            yield {"type": "reply", "reply": "unauthorized"}
+            return
+
+        changes = queue.Queue(FEED_QUEUE)
+        changes.lagging = False
+        with self.lock:
+            self.feeds.add(changes)
+            seq = self.journal.seq
+        try:
+            yield {"type": "reply", "reply": "success", "seq": seq}
+            if (backlog := self.backlog(cmd.get("since", 0), seq)) is None:
+                # The journal doesn't go back that far anymore, so the mirror
+                # gets the whole registry instead.
+                with self.lock:
+                    seq = self.journal.seq
+                    users, versions = self.registry.dump()
+                yield {"type": "snapshot", "seq": seq, "users": users}
+                for i in range(0, len(versions), FEED_BATCH):
+                    yield {"type": "versions", "versions": versions[i:i+FEED_BATCH]}
+                yield {"type": "restored"}
+            else:
+                for i in range(0, len(backlog), FEED_BATCH):
+                    yield {"type": "changes", "changes": [(s, op, args) for s, (op, args) in backlog[i:i+FEED_BATCH]]}
+
+            while True:
+                if changes.lagging and changes.empty():
+                    yield {"type": "resubscribe"}
+                    return
+                try:
+                    batch = [changes.get(timeout=FEED_HEARTBEAT)]
+                except queue.Empty:
+                    yield {"type": "heartbeat"}
+                    continue
+                while len(batch) < FEED_BATCH:
+                    try:
+                        batch.append(changes.get_nowait())
+                    except queue.Empty:
+                        break
+                if not (batch := [change for change in batch if change[0] > seq]):
+                    continue
+                # A mirror never gets ahead of what the primary would still
+                # have after a crash.
+                seq = batch[-1][0]
+                if self.coordinator is None:
+                    self.journal.wait(seq)
+                yield {"type": "changes", "changes": batch}
+        finally:
+            with self.lock:
+                self.feeds.discard(changes)
+
+    def backlog(self, since, until):
+        if since > until:
+            return None
+        if self.coordinator is None:
+            self.journal.wait(until)
+
+        # A worker hears about changes before the coordinator has written
+        # them out, so the last few may take a moment to show up on disk.
+        records = []
+        deadline = time.monotonic() + 1
+        while True:
+            records += self.journal.records(records[-1][0] if records else since, until)
+            if records and records[0][0] != since + 1:
+                return None
+            if (records[-1][0] if records else since) == until:
+                return records
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0.01)
+
+    def snapshot(self):
+        with self.lock:
+            seq = self.journal.rotate()
+            data = pickle.dumps((seq, self.registry.dump()), pickle.HIGHEST_PROTOCOL)
+        self.journal.save_snapshot(seq, data)
+        self.snapshotting = False
+
+    def limit_stats(self):
+        return {**self.limits.stats(), **self.turns.stats()}
+
+    def registry_stats(self):
+        return {"users": len(self.registry.users), "packages": len(self.registry.packages),
+                "blobs": len(self.registry.blobs), "journal_seq": self.journal.seq}
+
+    @coordinated
     def delete_user(self, user):
-        self.users.remove(self.get_user(user))
+        with self.lock:
+            if self.check_user(user):
+                return False
+            orphans, seq = self.apply("delete_user", user)
+        self.journal.wait(seq)
+        self.collect(orphans)
+        return True
+
+    def collect(self, orphans):
+        # Blobs only go once the deletion is durable, and only if no upload
+        # has started using them again in the meantime.
+        with self.lock:
+            for digest in orphans:
+                if digest not in self.registry.blobs:
+                    self.invalidate(digest)
+                    self.store.delete(digest)
 
     def package_exists(self, user, package):
-        for u in self.users:
-            if u != user:
-                for p in u.packages:
-                    if p == package:
-                        return True
+        return self.registry.package_exists(user, package)
 
-        return False
-
-    def add_package(self, user, package, version, content):
-        self.get_user(user).add_package(package, version, content)
+    def search(self, query, page):
+        results, total = self.registry.index.search(query, page)
+        found = []
+        for name, owner, description in results:
+            if (pack := self.registry.packages.get(name)) is not None:
+                found.append((name, pack.latest.version, owner, description))
+        return found, total
 
     def auth(self, username, password):
-        return self.get_user(username).auth(password)
+        return self.registry.auth(username, password)
 
     def get_version(self, package, version):
-        for user in self.users:
-            if pack := user.get_version(package, version):
-                return pack
-
-        return f"Package {package} does not exist"
+        return self.registry.get_version(package, version)
 
     def check_user(self, username):
-        return isinstance(self.get_user(username), str)
+        return self.registry.check_user(username)
 
     def get_user(self, username):
-        for user in self.users:
-            if user.username == username:
-                return user
-        return f"No user named {username}"
+        return self.registry.get_user(username)
 
+    @coordinated
     def add_user(self, username, password, email, website, github, description):
-        self.users.append(User(username, password, email, website, github, description))
+        with self.lock:
+            if not self.check_user(username):
+                return False
+            _, seq = self.apply("add_user", username, password, email, website, github, description)
+        self.journal.wait(seq)
+        return True
+
+    def add_client(self, client):
+        with self.clients_lock:
+            if len(self.clients) >= self.max_connections:
+                return False
+            self.clients.add(client)
+        self.metrics.connect()
+        return True
+
+    def remove_client(self, client):
+        # A timer left in the wheel would keep the closed connection, and
+        # its buffers, around until it went off.
+        if client.timer is not None:
+            self.timers.cancel(client.timer)
+        with self.clients_lock:
+            if client not in self.clients:
+                return
+            self.clients.discard(client)
+        self.metrics.disconnect()
+
+    @coordinated
+    def create_session(self, username, password):
+        if not self.auth(username, password):
+            return False
+        token = secrets.token_hex(32)
+        self.sessions[token] = (username, time.time() + SESSION_TTL)
+        self.expire_session(token)
+        if self.replicas is not None:
+            self.replicas.broadcast(("session", token, self.sessions[token]))
+        return token
+
+    def expire_session(self, token):
+        # Sessions nobody looks up again would otherwise stay forever.
+        self.timers.schedule(self.sessions[token][1] - time.time(), lambda: self.sessions.pop(token, None))
+
+    def session_user(self, token):
+        username, expires = self.sessions.get(token, (None, 0))
+        if expires < time.time() or self.check_user(username):
+            self.sessions.pop(token, None)
+            return None
+        return username
+
+    def handle(self, cmd):
+        if cmd["type"] == "user":
+            if cmd["method"] == "get":
+                return {"type": "reply", "reply": str(self.get_user(cmd["user"]))}
+
+            elif cmd["method"] == "create":
+                if not self.add_user(cmd["username"], cmd["password"], cmd["email"], cmd["website"], cmd["github"], cmd["description"]):
+                    return {"type": "reply", "reply": "exists"}
+                return {"type": "reply", "reply": "success"}
+
+            elif cmd["method"] == "verify":
+                if self.check_user(cmd["username"]):
+                    return {"type": "reply", "reply": "success"}
+                return {"type": "reply", "reply": "exists"}
+
+            elif cmd["method"] == "delete":
+                if self.session_user(cmd.get("token")) != cmd["user"]:
+                    return {"type": "reply", "reply": "unauthorized"}
+                if not self.delete_user(cmd["user"]):
+                    return {"type": "reply", "reply": f"No user named {cmd['user']}"}
+                return {"type": "reply", "reply": "success"}
+
+        elif cmd["type"] == "session":
+            if cmd.get("token"):
+                valid = self.session_user(cmd["token"]) == cmd["username"]
+                return {"type": "reply", "reply": cmd["token"] if valid else False}
+            return {"type": "reply", "reply": self.create_session(cmd["username"], cmd["password"])}
+
+        elif cmd["type"] == "preflight":
+            username, package = cmd["username"], cmd["package"]
+            token = cmd.get("token")
+            if token:
+                token = token if self.session_user(token) == username else False
+            else:
+                token = self.create_session(username, cmd.get("password"))
+            # The latest version already uploaded lets the client send only
+            # what changed since, if it still has a copy.
+            pack = self.registry.packages.get(package)
+            base = pack.newest if pack is not None and pack.owner == username else None
+            return {"type": "reply", "user": not self.check_user(username), "auth": bool(token), "token": token,
+                    "package": not self.package_exists(username, package),
+                    "version": isinstance(self.get_version(package, cmd["version"]), str),
+                    "base": base.digest if base is not None else None}
+
+        elif cmd["type"] == "auth":
+            return {"type": "reply", "reply": self.auth(cmd["username"], cmd["password"])}
+
+        elif cmd["type"] == "version":
+            return {"type": "reply", "reply": not isinstance(self.get_version(cmd["package"], cmd["version"]), str)}
+
+        elif cmd["type"] == "search":
+            if not self.registry.index.ready.is_set():
+                # Still being built after a start, or a mirror taking over
+                # a whole registry. The client asks again in a moment.
+                return self.busy(1)
+            page = max(1, int(cmd.get("page", 1)))
+            results, total = self.search(cmd["query"], page)
+            return {"type": "reply", "reply": results, "total": total, "page": page,
+                    "pages": -(-total // self.registry.index.page_size)}
+
+        elif cmd["type"] == "stats":
+            return {"type": "reply", "reply": self.metrics.snapshot()}
+
+        elif cmd["type"] == "package":
+            return {"type": "reply", "reply": self.package_exists(cmd["user"], cmd["package"])}
+
+        return {"type": "reply", "reply": f"Unknown command {cmd['type']}"}
+
+    def redirect(self, cmd):
+        # A mirror takes no writes, the client is sent to the primary instead.
+        if self.mirror is None:
+            return None
+        if cmd["type"] in ("session", "preflight", "upload") or \
+                (cmd["type"] == "user" and cmd.get("method") in ("create", "delete")):
+            return self.mirror.redirect("read only")
+
+    def admit(self, client, cmd):
+        # The busy reply for a client over its limits, None to go ahead.
+        # Only a user that is signed in counts, anyone can claim a name.
+        client.limited = []
+        if not self.limits.enabled or cmd["type"] in ("quit", "feed"):
+            return None
+        client.limited.append(("ip", client.addr[0]))
+        if (user := self.session_user(cmd.get("token"))) is not None:
+            client.limited.append(("user", user))
+        if retry := self.limits.admit(client.limited):
+            return self.busy(retry)
+
+    def busy(self, retry):
+        return {"type": "reply", "reply": "busy", "retry": round(retry, 3)}
+
+    def blocking(self, cmd):
+        if self.coordinator is not None and cmd["type"] in ("session", "preflight"):
+            return True
+        # A search waits for the index lock, which a write may be holding.
+        return cmd["type"] == "search" or (cmd["type"] == "user" and cmd["method"] in ("create", "delete"))
+
+    def install(self, cmd):
+        version = self.get_version(cmd["package"], cmd["version"])
+        if not isinstance(version, Version):
+            return {"type": "reply", "reply": version}, None
+
+        if cmd.get("cached") == version.digest:
+            return {"type": "reply", "reply": "not modified", "version": version.version, "digest": version.digest}, None
+        if self.mirror is not None and not self.mirror.ensure(version.digest):
+            return self.mirror.redirect("unavailable"), None
+
+        offset = cmd.get("offset", 0) if cmd.get("digest") == version.digest else 0
+        return {"type": "reply", "reply": "success", "version": version.version,
+                "size": version.size, "digest": version.digest, "offset": offset}, version
+
+    def batch(self, cmd):
+        versions = self.registry.resolve(cmd["packages"])
+        if isinstance(versions, str):
+            return {"type": "reply", "reply": versions}, []
+
+        packages = []
+        patches = []
+        partials = cmd.get("partials", {})
+        claimed = cmd.get("cached", {})
+        cached = {version.owner.name: self.known(version.owner.name, claimed.get(version.owner.name, ()))
+                  for version in versions}
+        if self.mirror is not None:
+            for version in versions:
+                if version.digest not in cached.get(version.owner.name, ()) and not self.mirror.ensure(version.digest):
+                    return self.mirror.redirect("unavailable"), []
+        for version in versions:
+            digest, offset = partials.get(version.owner.name, (None, 0))
+            # Only a part of this very version can be resumed.
+            if digest != version.digest or not isinstance(offset, int) or not 0 <= offset <= version.size:
+                offset = 0
+            entry = {"package": version.owner.name, "version": version.version, "size": version.size,
+                     "digest": version.digest, "offset": offset,
+                     "cached": version.digest in cached.get(version.owner.name, ())}
+
+            # A client holding an older version of the package only needs
+            # what changed since, as long as that's a lot less than all of it.
+            patch = None
+            if not entry["cached"] and not entry["offset"]:
+                base, patch = self.find_patch(version, cached.get(version.owner.name, ()))
+                if patch is not None:
+                    entry.update(patch=base, size=patch.stat().st_size)
+            packages.append(entry)
+            patches.append(patch)
+        return {"type": "reply", "reply": "success", "packages": packages}, list(zip(versions, patches))
+
+    def known(self, package, digests):
+        # The digests a client says it holds end up in paths in the store, so
+        # only those of versions of the package itself are ever used.
+        if (pack := self.registry.packages.get(package)) is None:
+            return []
+        versions = {ver.digest for ver in pack.sorted[1]}
+        return [digest for digest in digests if isinstance(digest, str) and DIGEST.fullmatch(digest) and digest in versions]
+
+    def find_patch(self, version, bases):
+        if version.size < delta.MIN_SIZE or not bases:
+            return None, None
+        digest = version.digest
+        if (stored := self.store.base(digest)) in bases:
+            return stored, self.store.delta_path(digest)
+
+        for base in bases:
+            if base == digest or base not in self.store:
+                continue
+            path = self.store.patch_path(base, digest)
+            try:
+                if not path.exists():
+                    self.make_patch(base, digest, version.size, path)
+            except (OSError, delta.DeltaError):
+                return None, None
+            # An empty file records that the versions have too little in
+            # common, so the next client asking doesn't wait for that again.
+            return (base, path) if path.stat().st_size else (None, None)
+        return None, None
+
+    def make_patch(self, base, digest, size, path):
+        sig = delta.signature(self.store.pieces(base), delta.block_size(self.store.size(base)))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.store.tmp, suffix=".patch")
+        with os.fdopen(fd, "wb") as f, self.store.materialized(digest) as target:
+            if not delta.related(sig, target, size) or \
+                    delta.diff(sig, base, delta.chunks(target), size, f, delta.budget(size)) is None:
+                f.truncate(0)
+        os.replace(tmp, path)
+
+    def compact(self):
+        # Uploads are stored in full first, and converted to a delta against
+        # the version before them in the background once they're durable.
+        while True:
+            package, version = self.deltas.get()
+            try:
+                self.store_delta(package, version)
+            except (OSError, delta.DeltaError) as e:
+                print(f"[SERVER] Could not store {package}={version} as a delta: {e}")
+
+    def store_delta(self, package, version):
+        if (pack := self.registry.packages.get(package)) is None or (ver := pack.versions.get(version)) is None:
+            return
+        ordered = pack.sorted[1]
+        index = ordered.index(ver)
+        if not (neighbours := ordered[index-1:index] or ordered[index+1:index+2]):
+            return
+
+        # Deltas are only ever made against full blobs, so rebuilding a
+        # version never takes more than one step.
+        digest = ver.digest
+        base = self.store.base(neighbours[0].digest) or neighbours[0].digest
+        if base == digest or ver.size < delta.MIN_SIZE or not self.store.is_full(digest) or \
+                self.store.dependents(digest) or not self.store.is_full(base):
+            return
+
+        sig = delta.signature(self.store.pieces(base), delta.block_size(self.store.size(base)))
+        with self.store.open(digest) as target:
+            if not delta.related(sig, target, ver.size):
+                return
+            tmp = self.store.tmp / f"{digest}.delta"
+            with open(tmp, "wb") as f:
+                size = delta.diff(sig, base, delta.chunks(target), ver.size, f, delta.budget(ver.size))
+                f.flush()
+                os.fsync(f.fileno())
+
+        with self.lock:
+            if size is not None and digest in self.registry.blobs and base in self.registry.blobs and \
+                    self.store.is_full(digest) and self.store.is_full(base) and not self.store.dependents(digest):
+                self.store.convert(digest, base, tmp)
+                return
+        os.remove(tmp)
+
+    def build_stream(self, digest, size):
+        if not self.hot.admit(digest, size):
+            return None
+        with self.store.materialized(digest) as f:
+            data = encode_stream(f)
+        self.hot.put(digest, data)
+        return data
+
+    def blob(self, cmd):
+        # Mirrors pull the blobs they're missing by digest, picking up where
+        # an interrupted pull stopped.
+        digest = cmd["digest"]
+        if digest not in self.registry.blobs or digest not in self.store:
+            return {"type": "reply", "reply": f"No blob {digest}"}, None
+        size = self.store.size(digest)
+        return {"type": "reply", "reply": "success", "size": size, "offset": min(cmd.get("offset", 0), size)}, size
+
+    def upload_error(self, user, package, version):
+        if NAME.fullmatch(package) is None:
+            return f"Invalid package name {package}"
+        if VERSION.fullmatch(version) is None:
+            return f"Invalid version {version}"
+        if self.check_user(user):
+            return f"No user named {user}"
+        if self.package_exists(user, package):
+            return f"Package {package} already exists"
+        if not isinstance(self.get_version(package, version), str):
+            return f"Version {version} already exists"
+
+    def check_upload(self, cmd):
+        if self.session_user(cmd.get("token")) != cmd["user"]:
+            return {"type": "reply", "reply": "unauthorized"}
+        if (error := self.upload_error(cmd["user"], cmd["package"], cmd["version"])) is not None or \
+                (error := dependency_error(cmd.get("dependencies", ()))) is not None:
+            return {"type": "reply", "reply": error}
+        if cmd.get("patch") and not self.known(cmd["package"], (cmd["patch"],)):
+            return {"type": "reply", "reply": f"No version of {cmd['package']} with digest {cmd['patch']}"}
+
+    def begin_upload(self, cmd):
+        return self.store.begin("/".join((cmd["user"], cmd["package"], cmd["version"], cmd.get("digest") or "",
+                                          cmd.get("patch") or "")))
+
+    def apply_patch(self, cmd, upload):
+        full = self.store.begin("/".join((cmd["user"], cmd["package"], cmd["version"], cmd["digest"])), fresh=True)
+        try:
+            with self.store.materialized(cmd["patch"]) as base, open(upload.path, "rb") as patch:
+                if delta.read_header(patch)[0] != cmd["patch"]:
+                    raise delta.DeltaError("Patch is against another version")
+                for piece in delta.patch(base, patch):
+                    full.write(piece)
+        except (FileNotFoundError, delta.DeltaError):
+            self.store.discard(full)
+            return None
+        finally:
+            self.store.discard(upload)
+        full.close()
+        return full
+
+    def finish_upload(self, cmd, upload):
+        if cmd.get("patch") and (upload := self.apply_patch(cmd, upload)) is None:
+            return {"type": "reply", "reply": "corrupt"}
+        if upload.digest() != cmd["digest"]:
+            self.store.discard(upload)
+            return {"type": "reply", "reply": "corrupt"}
+        upload.close()
+        return self.publish(cmd, str(upload.path), upload.digest(), upload.size)
+
+    @coordinated
+    def publish(self, cmd, path, digest, size):
+        # Another upload of the same package may have finished while this one
+        # was streaming, so the checks are made again under the lock. The blob
+        # is committed under it too so a concurrent delete_user can't remove
+        # it between landing in the store and being referenced.
+        with self.lock:
+            if (error := self.upload_error(cmd["user"], cmd["package"], cmd["version"])) is not None:
+                os.remove(path)
+                return {"type": "reply", "reply": error}
+            self.store.place(path, digest)
+            _, seq = self.apply("add_package", cmd["user"], cmd["package"], cmd["version"], digest, size,
+                                time.time(), tuple(map(tuple, cmd.get("dependencies", ()))), cmd.get("description"))
+        self.journal.wait(seq)
+        self.deltas.put((cmd["package"], cmd["version"]))
+        return {"type": "reply", "reply": "success"}
+
+    def invalidate(self, digest):
+        self.hot.invalidate(digest)
+        if self.replicas is not None:
+            self.replicas.broadcast(("invalidate", digest))
+
+    def replicate(self, message):
+        # Runs on a worker's link thread, the only thread there that changes
+        # the registry, with the same copy-on-write swaps the coordinator uses.
+        kind = message[0]
+        if kind == "op":
+            _, seq, op, args = message
+            with self.lock:
+                getattr(self.registry, op)(*args)
+                # A worker's journal is never written to, it only keeps count.
+                self.journal.seq = seq
+                self.announce(seq, op, args)
+        elif kind == "session":
+            self.sessions[message[1]] = message[2]
+            self.expire_session(message[1])
+        elif kind == "invalidate":
+            self.hot.invalidate(message[1])
+
+    def prefork(self, workers, asynchronous=False, metrics=None):
+        # Workers are forked once the search index is complete so they all
+        # share the parent's registry pages rather than each building its own.
+        self.registry.index.ready.wait()
+        gc.freeze()
+        self.server.close()
+        self.timers = TimerWheel()
+
+        context = multiprocessing.get_context("fork")
+        pipes = [context.Pipe() for _ in range(workers)]
+        processes = [context.Process(target=self.work, args=(index, pipes, asynchronous, metrics))
+                     for index in range(workers)]
+        for process in processes:
+            process.start()
+        self.replicas = Coordinator(self)
+        for parent, child in pipes:
+            child.close()
+            self.replicas.add(parent)
+        print(f"[SERVER] Coordinating {workers} workers on IP {self.host} and PORT {self.port}")
+        if self.mirror is not None:
+            self.mirror.start()
+
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+        self.quit()
+
+    def work(self, index, pipes, asynchronous, metrics):
+        for i, (parent, child) in enumerate(pipes):
+            parent.close()
+            if i != index:
+                child.close()
+        self.timers = TimerWheel()
+        self.coordinator = Link(pipes[index][1], self.replicate)
+        self.server = listener(self.host, self.port)
+        if metrics:
+            self.metrics.serve("127.0.0.1", metrics + index)
+        if asynchronous:
+            asyncio.run(self.start_async())
+        else:
+            self.start()
+
+    def watch(self, client, delay=None):
+        if self.idle_timeout:
+            client.timer = self.timers.schedule(delay or self.idle_timeout, client.expire)
+            # Rescheduled from expire() just as the connection closed.
+            if not client.active:
+                self.timers.cancel(client.timer)
 
     def start(self):
-        print(f"[SERVER] Started on IP {IP} and PORT {PORT}")
-        threading.Thread(target=self.cleanup).start()
-        self.server.listen()
+        print(f"[SERVER] Started on IP {self.host} and PORT {self.port}")
+        if self.timers is None:
+            self.timers = TimerWheel()
+        self.server.listen(self.listen_backlog)
 
         while True:
             try:
                 conn, addr = self.server.accept()
+                # Replies are often written as a message frame followed by a
+                # small stream, Nagle would hold the second write back until
+                # the client's delayed ACK for the first one.
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                keepalive(conn)
                 client = Client(conn, addr, self)
-                self.clients.append(client)
+                if not self.add_client(client):
+                    client.send({"type": "force_quit"})
+                    client.quit()
+                    continue
                 threading.Thread(target=client.start).start()
 
             except KeyboardInterrupt:
                 self.quit()
 
-    def cleanup(self):
-        while self.active:
-            time.sleep(0.1)
-            for i, c in enumerate(self.clients):
-                if not c.active:
-                    c.quit()
-                    self.clients.pop(i)
+    async def start_async(self):
+        print(f"[SERVER] Started on IP {self.host} and PORT {self.port} (async)")
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = self.max_connections + 1024
+        if soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted if hard == resource.RLIM_INFINITY else min(wanted, hard), hard))
+        if self.timers is None:
+            self.timers = TimerWheel()
+
+        self.server.listen(self.listen_backlog)
+        server = await asyncio.start_server(self.accept_async, sock=self.server, limit=STREAM_LIMIT,
+                                            backlog=self.listen_backlog)
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.quit()
+
+    async def accept_async(self, reader, writer):
+        # asyncio leaves Nagle on for sockets it accepts from a listening
+        # socket it was handed, the same stall the threaded server avoids.
+        sock = writer.get_extra_info("socket")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        keepalive(sock)
+        client = AsyncClient(reader, writer, self)
+        if not self.add_client(client):
+            await client.send({"type": "force_quit"})
+            client.quit()
+            return
+
+        await client.start()
 
     def quit(self):
         self.active = False
         self.server.close()
-        for c in self.clients:
+        with self.clients_lock:
+            clients = list(self.clients)
+        for c in clients:
             c.quit()
+        if self.coordinator is None:
+            self.snapshot()
+            self.journal.close()
         print("[SERVER] Stopping")
         ctypes.pointer(ctypes.c_char.from_address(5))[0]
 
 
-class Client:
-    header = 64
-    padding = " " * header
-    packet_size = 8192
+class Timings:
+    def begin(self, start, received, decoded):
+        self.phases = {"recv": received - start, "decode": decoded - received, "lookup": 0.0, "encode": 0.0, "send": 0.0}
+        self.handled = decoded
+        self.waited = self.phases["recv"]
 
-    def __init__(self, conn, addr, server):
-        self.conn = conn
+    def record(self, cmd):
+        # Whatever part of handling the command wasn't spent on the socket or
+        # encoding the reply went into looking things up.
+        phases = self.phases
+        elapsed = time.perf_counter() - self.handled
+        phases["lookup"] = max(0.0, elapsed - (phases["recv"] - self.waited) - phases["encode"] - phases["send"])
+
+        received, sent = self.received - self.counted[0], self.sent - self.counted[1]
+        self.counted = (self.received, self.sent)
+        self.server.metrics.observe(cmd.get("type"), phases, received, sent)
+        if self.limited:
+            self.server.limits.charge(self.limited, received + sent)
+
+
+class Lifecycle:
+    # A connection is closed once it has gone idle_timeout seconds without a
+    # request. Requests don't touch the timer, when it goes off it looks at
+    # how long ago the last one was and sets itself again for the rest.
+    def connected(self, addr, server):
         self.addr = addr
         self.server = server
 
         self.active = True
-        self.last_move = 0
+        self.handling = False
+        self.touched = time.monotonic()
+        self.timer = None
+        self.counted = (0, 0)
+        self.limited = []
+        self.phases = dict.fromkeys(PHASES, 0.0)
         self.alert("Connected")
 
     def alert(self, msg):
         if self.server.active:
             print(f"[{self.addr}] {msg}")
 
-    def start(self):
-        while True:
-            cmd = self.recv()
-
-            if not self.server.active:
+    def expire(self):
+        if not self.active:
+            return
+        idle = time.monotonic() - self.touched
+        if self.handling or idle < self.server.idle_timeout:
+            self.server.watch(self, None if self.handling else self.server.idle_timeout - idle)
+            return
+        self.alert("Idle for too long, disconnecting")
+        self.hang_up()
+
+
+class Dispatch:
+    # What each command does, written once for both kinds of connection.
+    # Every step that talks to the client, or may block, is yielded as the
+    # name of a method and its arguments. A threaded connection just calls
+    # it, an asyncio one awaits it, running whatever blocks off the loop.
+    def session(self):
+        # Every frame the connection gets until it closes, in the same steps
+        # as dispatch, which runs within it.
+        self.server.watch(self)
+        try:
+            while self.active:
+                kind, length = yield "read_header",
+                start = time.perf_counter()
+                if kind == HELLO:
+                    self.hello((yield "read_payload", length))
+                    yield "send_frame", HELLO, offer()
+                    continue
+                if kind != MESSAGE:
+                    raise ProtocolError(f"Expected frame kind {MESSAGE}, got {kind}")
+                data = yield "read_payload", length
+                received = time.perf_counter()
+                cmd = decode(data)
+                if not isinstance(cmd, dict) or not isinstance(cmd.get("type"), str):
+                    raise ProtocolError("Expected a command")
+                self.begin(start, received, time.perf_counter())
+
+                if not self.server.active:
+                    self.quit()
+                    return
+
+                self.handling = True
+                sent = self.sent
+                try:
+                    yield from self.dispatch(cmd)
+                except (KeyError, TypeError, ValueError) as e:
+                    yield "send", self.malformed(e, sent)
+                finally:
+                    self.handling = False
+                self.record(cmd)
+                self.touched = time.monotonic()
+
+        except (OSError, ProtocolError):
+            # Whatever went wrong with the socket, or a peer sending garbage,
+            # the connection is done with.
+            self.quit()
+            self.alert("Disconnected")
+        finally:
+            # Anything else still ends the connection instead of leaving the
+            # socket open with nobody reading it.
+            if self.active:
                 self.quit()
+            self.server.remove_client(self)
+
+    def malformed(self, error, sent):
+        # A command missing a field, or with one of the wrong type. Once part
+        # of a reply has gone out the client can't tell where it stopped, so
+        # the connection is dropped instead.
+        if self.sent != sent:
+            raise ProtocolError(f"Malformed command: {error!r}")
+        return {"type": "reply", "reply": f"Malformed command: {error!r}"}
+
+    def dispatch(self, cmd):
+        server = self.server
+        if (redirect := server.redirect(cmd)) is not None:
+            yield "send", redirect
+
+        elif (busy := server.admit(self, cmd)) is not None:
+            yield "send", busy
+
+        elif cmd["type"] == "quit":
+            self.quit()
+            self.alert("Disconnected")
+
+        elif cmd["type"] == "install":
+            # A mirror may have to pull the blob from its primary first.
+            if server.mirror is not None:
+                reply, version = yield "call", server.install, cmd
+            else:
+                reply, version = server.install(cmd)
+            size = version.size - reply["offset"] if version is not None else 0
+            if not (yield from self.take_turn(size)):
+                yield "send", server.busy(1)
                 return
-
-            if cmd["type"] == "quit":
-                self.quit()
-                self.alert("Disconnected")
+            try:
+                yield "send", reply
+                if version is not None:
+                    yield "send_version", version.digest, version.size, reply["offset"]
+            finally:
+                self.leave_turn(size)
+
+        elif cmd["type"] == "batch":
+            # Working out patches reads whole blobs.
+            reply, versions = yield "call", server.batch, cmd
+            size = sum(entry["size"] - entry["offset"] for entry in reply.get("packages", ()) if not entry["cached"])
+            if not (yield from self.take_turn(size)):
+                yield "send", server.busy(1)
+                return
+            try:
+                yield "send", reply
+                for (version, patch), entry in zip(versions, reply.get("packages", ())):
+                    if patch is not None:
+                        yield "send_patch", patch
+                    elif not entry["cached"]:
+                        yield "send_version", version.digest, version.size, entry["offset"]
+            finally:
+                self.leave_turn(size)
+
+        elif cmd["type"] == "blob":
+            reply, size = server.blob(cmd)
+            if not (yield from self.take_turn(size or 0)):
+                yield "send", server.busy(1)
+                return
+            try:
+                yield "send", reply
+                if size is not None:
+                    yield "send_version", cmd["digest"], size, reply["offset"]
+            finally:
+                self.leave_turn(size or 0)
+
+        elif cmd["type"] == "feed":
+            # The feed blocks between changes.
+            changes = server.feed(cmd)
+            try:
+                while (message := (yield "call", next, changes, None)) is not None:
+                    yield "send", message
+            finally:
+                changes.close()
+
+        elif cmd["type"] == "upload":
+            if (error := server.check_upload(cmd)) is not None:
+                yield "send", error
                 return
+            if not (yield from self.take_turn(None)):
+                yield "send", server.busy(1)
+                return
+            try:
+                # Picking up a partial upload hashes what's already there.
+                upload = yield "call", server.begin_upload, cmd
+                yield "send", {"type": "reply", "reply": "ready", "offset": upload.size}
+                start = time.perf_counter()
+                try:
+                    yield "recv_stream", upload, upload.size
+                    if not cmd.get("digest"):
+                        cmd["digest"] = (yield "recv",)["digest"]
+                finally:
+                    self.phases["recv"] += time.perf_counter() - start
+                    yield "call", upload.close
+                yield "send", (yield "call", server.finish_upload, cmd, upload)
+            finally:
+                self.leave_turn(None)
+
+        elif server.blocking(cmd):
+            yield "send", (yield "call", server.handle, cmd)
+
+        else:
+            yield "send", server.handle(cmd)
 
-            elif cmd["type"] == "user":
-                if cmd["method"] == "get":
-                    self.send({"type": "reply", "reply": str(self.server.get_user(cmd["user"]))})
+    def take_turn(self, size):
+        # Uploads, whatever size they claim, and large installs wait for a
+        # turn at the server's work slots.
+        if size is not None and size < LARGE_TRANSFER:
+            return True
+        return (yield "wait_turn",)
 
-                elif cmd["method"] == "create":
-                    self.server.add_user(cmd["username"], cmd["password"], cmd["email"], cmd["website"], cmd["github"], cmd["description"])
-                    self.send({"type": "reply", "reply": "success"})
+    def leave_turn(self, size):
+        if size is None or size >= LARGE_TRANSFER:
+            self.server.turns.leave()
 
-                elif cmd["method"] == "verify":
-                    if self.server.check_user(cmd["username"]):
-                        self.send({"type": "reply", "reply": "success"})
-                    else:
-                        self.send({"type": "reply", "reply": "exists"})
 
-                elif cmd["method"] == "delete":
-                    self.server.delete_user(cmd["user"])
-                    self.send({"type": "reply", "reply": "success"})
+class Client(Timings, Lifecycle, Dispatch, Connection):
+    def __init__(self, conn, addr, server):
+        super().__init__(conn)
+        self.connected(addr, server)
 
-            elif cmd["type"] == "install":
-                version = self.server.get_version(cmd["package"], cmd["version"])
-                if isinstance(version, Version):
-                    self.send({"type": "reply", "reply": version.content})
-                else:
-                    self.send({"type": "reply", "reply": version})
+    def start(self):
+        steps = self.session()
+        result = error = None
+        try:
+            while True:
+                try:
+                    name, *args = steps.send(result) if error is None else steps.throw(error)
+                except StopIteration:
+                    return
+                try:
+                    result, error = getattr(self, name)(*args), None
+                except Exception as e:
+                    result, error = None, e
+        finally:
+            steps.close()
+
+    def call(self, function, *args):
+        return function(*args)
+
+    def wait_turn(self):
+        return self.server.turns.wait(self.addr[0], WORK_WAIT)
 
-            elif cmd["type"] == "upload":
-                self.server.add_package(cmd["user"], cmd["package"], cmd["version"], cmd["content"])
-                self.send({"type": "reply", "reply": "success"})
+    def send(self, obj):
+        start = time.perf_counter()
+        data = self.encode(obj)
+        encoded = time.perf_counter()
+        self.send_frame(MESSAGE, data)
+        self.phases["encode"] += encoded - start
+        self.phases["send"] += time.perf_counter() - encoded
+
+    def send_version(self, digest, size, offset):
+        if not offset:
+            data = self.server.hot.get(digest) or self.server.build_stream(digest, size)
+            if data is not None:
+                start = time.perf_counter()
+                self.send_raw(data)
+                self.phases["send"] += time.perf_counter() - start
+                return
 
-            elif cmd["type"] == "auth":
-                self.send({"type": "reply", "reply": self.server.auth(cmd["username"], cmd["password"])})
+        start = time.perf_counter()
+        if self.server.store.is_full(digest):
+            with self.server.store.open(digest) as f:
+                self.send_file(f, offset)
+        else:
+            self.send_pieces(self.server.store.pieces(digest, offset), offset)
+        self.phases["send"] += time.perf_counter() - start
 
-            elif cmd["type"] == "version":
-                self.send({"type": "reply", "reply": not isinstance(self.server.get_version(cmd["package"], cmd["version"]), str)})
+    def send_patch(self, path):
+        start = time.perf_counter()
+        with open(path, "rb") as f:
+            self.send_file(f)
+        self.phases["send"] += time.perf_counter() - start
 
-            elif cmd["type"] == "package":
-                self.send({"type": "reply", "reply": self.server.package_exists(cmd["user"], cmd["package"])})
+    def hang_up(self):
+        self.quit()
 
     def quit(self):
+        # A recv blocked on the socket in another thread only wakes up for a
+        # shutdown, closing it isn't enough.
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.conn.close()
         self.active = False
 
-    def send(self, obj):
-        data = zlib.compress(pickle.dumps(obj))
-        len_msg = (str(len(data)) + self.padding)[:self.header].encode()
 
-        packets = []
-        while data:
-            curr_len = min(len(data), self.packet_size)
-            packets.append(data[:curr_len])
-            data = data[curr_len:]
+class AsyncClient(Timings, Lifecycle, Dispatch, AsyncConnection):
+    def __init__(self, reader, writer, server):
+        super().__init__(reader, writer)
+        self.loop = asyncio.get_running_loop()
+        self.connected(writer.get_extra_info("peername"), server)
+
+    async def start(self):
+        steps = self.session()
+        result = error = None
+        try:
+            while True:
+                try:
+                    name, *args = steps.send(result) if error is None else steps.throw(error)
+                except StopIteration:
+                    return
+                try:
+                    result, error = await getattr(self, name)(*args), None
+                except Exception as e:
+                    result, error = None, e
+        finally:
+            # Cancelled along with the server, the connection still closes.
+            steps.close()
+
+    async def call(self, function, *args):
+        return await self.loop.run_in_executor(None, function, *args)
+
+    async def wait_turn(self):
+        return await self.server.turns.wait_async(self.addr[0], WORK_WAIT)
+
+    async def send(self, obj):
+        start = time.perf_counter()
+        data = self.encode(obj)
+        encoded = time.perf_counter()
+        await self.send_frame(MESSAGE, data)
+        self.phases["encode"] += encoded - start
+        self.phases["send"] += time.perf_counter() - encoded
+
+    async def send_version(self, digest, size, offset):
+        if not offset:
+            data = self.server.hot.get(digest)
+            if data is None:
+                data = await self.call(self.server.build_stream, digest, size)
+            if data is not None:
+                start = time.perf_counter()
+                await self.send_raw(data)
+                self.phases["send"] += time.perf_counter() - start
+                return
 
-        self.conn.send(len_msg)
-        for packet in packets:
-            self.conn.send(packet)
+        start = time.perf_counter()
+        store = self.server.store
+        if store.is_full(digest):
+            f = store.open(digest)
+        else:
+            f = await self.call(store.temporary, digest)
+        with f:
+            await self.send_file(f, offset)
+        self.phases["send"] += time.perf_counter() - start
 
-    def recv(self):
-        len_msg = b""
-        while len(len_msg) < self.header:
-            len_msg += self.conn.recv(self.header-len(len_msg))
+    async def send_patch(self, path):
+        start = time.perf_counter()
+        with open(path, "rb") as f:
+            await self.send_file(f)
+        self.phases["send"] += time.perf_counter() - start
 
-        length = int(len_msg)
-        data = b""
-        while len(data) < length:
-            curr_len = min(self.packet_size, length-len(data))
-            data += self.conn.recv(curr_len)
+    def hang_up(self):
+        # The timer goes off on its own thread, the transport belongs to the loop.
+        self.loop.call_soon_threadsafe(self.quit)
 
-        return pickle.loads(zlib.decompress(data))
+    def quit(self):
+        self.writer.close()
+        self.active = False
 
 
 def main():
-    server = Server()
-    server.start()
-
-
-main()
+    settings, _ = config.load("server", sys.argv[1:], ("host", "port", "data", "metrics", "workers", "compression",
+                                                       "compression_level", "mirror", "mirror_token", "rate_limit",
+                                                       "rate_burst", "byte_limit", "byte_burst", "work_slots",
+                                                       "work_queue", "idle_timeout", "max_connections",
+                                                       "backlog"), ("async",))
+    protocol.configure(settings.get("compression"), settings.get("compression_level"))
+    server = Server(*config.address(settings), settings.get("data") or DATA)
+    server.max_connections = int(settings.get("max_connections") or MAX_CONNECTIONS)
+    server.listen_backlog = int(settings.get("backlog") or BACKLOG)
+    # Requests per second and bytes per second for each client address and
+    # each signed in user, unlimited unless set.
+    server.limits = RateLimiter(*(float(settings.get(key) or 0) for key in ("rate_limit", "rate_burst", "byte_limit",
+                                                                           "byte_burst")))
+    server.turns = FairQueue(int(settings.get("work_slots") or WORK_SLOTS), int(settings.get("work_queue") or WORK_QUEUE))
+    # 0 keeps idle connections open for good.
+    server.idle_timeout = float(settings.get("idle_timeout", IDLE_TIMEOUT))
+    # Mirrors present the token to follow this server, and a mirror presents
+    # it to its own primary.
+    server.mirror_token = settings.get("mirror_token")
+    if settings.get("mirror"):
+        server.mirror = Mirror(server, config.endpoints(settings["mirror"], settings["port"])[0], server.mirror_token)
+        print(f"[SERVER] Mirroring {settings['mirror']}, read only")
+    port = int(settings.get("metrics") or 0)
+    if workers := int(settings.get("workers") or 0):
+        # Each worker serves its own metrics, on consecutive ports.
+        if port:
+            print(f"[SERVER] Metrics on http://127.0.0.1:{port}-{port + workers - 1}/metrics")
+        server.prefork(workers, config.enabled(settings, "async"), port)
+        return
+    if port:
+        # Only ever on localhost, the endpoint is meant for a local scraper.
+        server.metrics.serve("127.0.0.1", port)
+        print(f"[SERVER] Metrics on http://127.0.0.1:{port}/metrics")
+    if server.mirror is not None:
+        server.mirror.start()
+    if config.enabled(settings, "async"):
+        asyncio.run(server.start_async())
+    else:
+        server.start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from hashlib import sha256
+from contextlib import contextmanager
+
+import delta
+
+
+class Upload:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a+b")
+        self.hash = sha256()
+
+        self.file.seek(0)
+        while chunk := self.file.read(1 << 20):
+            self.hash.update(chunk)
+        self.size = self.file.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def truncate(self):
+        return self.file.truncate()
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def digest(self):
+        return self.hash.hexdigest()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+
+class BlobStore:
+    # A blob is kept either in full or as a delta against a full blob of an
+    # earlier version, never against another delta. Every full blob that
+    # deltas were made against lists them in its .deps directory so it can
+    # hand them their own full copy before it goes away.
+    def __init__(self, root):
+        self.root = Path(root)
+        self.tmp = self.root / "tmp"
+        self.tmp.mkdir(parents=True, exist_ok=True)
+
+    def path(self, digest):
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    def delta_path(self, digest):
+        return self.path(digest).with_name(digest + ".delta")
+
+    def deps_path(self, digest):
+        return self.path(digest).with_name(digest + ".deps")
+
+    def patch_path(self, base, digest):
+        return self.root / "patches" / digest[:2] / digest / base
+
+    def __contains__(self, digest):
+        return self.path(digest).is_file() or self.delta_path(digest).is_file()
+
+    def is_full(self, digest):
+        return self.path(digest).is_file()
+
+    def base(self, digest):
+        if self.is_full(digest):
+            return None
+        try:
+            with open(self.delta_path(digest), "rb") as f:
+                return delta.read_header(f)[0]
+        except FileNotFoundError:
+            return None
+
+    def dependents(self, digest):
+        try:
+            return os.listdir(self.deps_path(digest))
+        except FileNotFoundError:
+            return []
+
+    def open(self, digest):
+        return open(self.path(digest), "rb")
+
+    def size(self, digest):
+        try:
+            return self.path(digest).stat().st_size
+        except FileNotFoundError:
+            with open(self.delta_path(digest), "rb") as f:
+                return delta.read_header(f)[1]
+
+    def pieces(self, digest, offset=0):
+        # Whichever form the blob is in, its full content. A delta is written
+        # before the full copy it replaces is removed and the other way round,
+        # so one of the two is always there.
+        try:
+            f = open(self.path(digest), "rb")
+        except FileNotFoundError:
+            f = None
+        if f is not None:
+            with f:
+                yield from delta.chunks(f, offset)
+            return
+
+        with open(self.delta_path(digest), "rb") as d:
+            base, _ = delta.read_header(d)
+            with self.open(base) as b:
+                yield from delta.patch(b, d, offset)
+
+    def temporary(self, digest):
+        f = tempfile.TemporaryFile(dir=self.tmp)
+        for piece in self.pieces(digest):
+            f.write(piece)
+        f.seek(0)
+        return f
+
+    @contextmanager
+    def materialized(self, digest):
+        try:
+            f = self.open(digest)
+        except FileNotFoundError:
+            f = self.temporary(digest)
+        with f:
+            yield f
+
+    def begin(self, key, fresh=False):
+        path = self.tmp / sha256(key.encode()).hexdigest()
+        if fresh:
+            path.unlink(missing_ok=True)
+        return Upload(path)
+
+    def place(self, source, digest):
+        if digest in self:
+            os.remove(source)
+        else:
+            path = self.path(digest)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(source, path)
+        return digest
+
+    def discard(self, upload):
+        upload.close()
+        os.remove(upload.path)
+
+    def convert(self, digest, base, tmp):
+        deps = self.deps_path(base)
+        deps.mkdir(exist_ok=True)
+        (deps / digest).touch()
+        os.replace(tmp, self.delta_path(digest))
+        os.remove(self.path(digest))
+
+    def materialize(self, digest):
+        if self.is_full(digest) or (base := self.base(digest)) is None:
+            return
+        tmp = self.tmp / f"{digest}.full"
+        with open(tmp, "wb") as f:
+            for piece in self.pieces(digest):
+                f.write(piece)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path(digest))
+        os.remove(self.delta_path(digest))
+        (self.deps_path(base) / digest).unlink(missing_ok=True)
+
+    def delete(self, digest):
+        for dependent in self.dependents(digest):
+            self.materialize(dependent)
+        shutil.rmtree(self.deps_path(digest), ignore_errors=True)
+
+        if (base := self.base(digest)) is not None:
+            (self.deps_path(base) / digest).unlink(missing_ok=True)
+        for path in (self.path(digest), self.delta_path(digest)):
+            path.unlink(missing_ok=True)
+        shutil.rmtree(self.root / "patches" / digest[:2] / digest, ignore_errors=True)
@@ -0,0 +1,98 @@
+#
+#  Cip
+#  C++ Package Manager.
+#  Copyright Arjun Sahlot 2021
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import math
+import time
+import threading
+
+
+class Timer:
+    __slots__ = ("due", "callback")
+
+    def __init__(self, due, callback):
+        self.due = due
+        self.callback = callback
+
+
+class TimerWheel:
+    # A hashed timing wheel. Each timer goes into the slot of the tick it's
+    # due in, so adding one costs the same however many there are and each
+    # tick only looks at a single slot, where timers due a lap or more later
+    # just stay. With nothing scheduled the thread sleeps until something is.
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        self.pending = 0
+        self.current = self.ticks(time.monotonic())
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def ticks(self, now):
+        return math.floor(now / self.tick)
+
+    def schedule(self, delay, callback):
+        timer = Timer(math.ceil((time.monotonic() + delay) / self.tick), callback)
+        with self.lock:
+            # Never into a tick that has been swept already, it'd wait a lap.
+            timer.due = max(timer.due, self.current + 1)
+            self.slots[timer.due % len(self.slots)].append(timer)
+            self.pending += 1
+            if self.pending == 1:
+                self.wake.notify()
+        return timer
+
+    def cancel(self, timer):
+        # Taken out of its slot when the wheel next passes it.
+        timer.callback = None
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.wake.wait()
+                    # Ticks slept through with nothing scheduled have nothing to fire.
+                    self.current = self.ticks(time.monotonic()) - 1
+
+                now = self.ticks(time.monotonic())
+                fired = []
+                # More than a lap behind still only needs every slot once.
+                for tick in range(max(self.current + 1, now - len(self.slots) + 1), now + 1):
+                    slot = self.slots[tick % len(self.slots)]
+                    if not slot:
+                        continue
+                    kept = []
+                    for timer in slot:
+                        if timer.callback is None:
+                            self.pending -= 1
+                        elif timer.due <= now:
+                            fired.append(timer.callback)
+                            self.pending -= 1
+                        else:
+                            kept.append(timer)
+                    slot[:] = kept
+                self.current = now
+                if self.pending:
+                    self.wake.wait((now + 1) * self.tick - time.monotonic())
+
+            for callback in fired:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"[TIMERS] {callback!r} failed: {e}")